@@ -1,6 +1,8 @@
 from solver import solve_numerical
 from input_parser import parse_input_file, parse_table
 from solver import solve_generic
+from constraints import solve_numerical_constrained, constrained_update
+from plot import plot_with_EN
 import numpy as np
 
 filename = "micro_cathode.input"
@@ -22,12 +24,16 @@ gap_area = np.pi * parameters['radius'] ** 2
 voltage = 1000.0
 resistance = 1.0e5
 
-def update(prmtrs, time):
+def circuit(EN, prmtrs):
+    # the circuit as an equation for E/N solved implicitly: voltage = E * gap_length + resistance * J
     neutral_particles = prmtrs['Ar'] + prmtrs['Ar*']
-    J = q_elem * gap_area * prmtrs['e'] * mobility(prmtrs['EN']) * prmtrs['EN'] * Td_to_Vm2
-    prmtrs['EN'] = Vm2_to_Td * voltage / neutral_particles / \
-                   (prmtrs['gap_length'] + resistance * J / (prmtrs['EN'] * Td_to_Vm2 * neutral_particles))
-    prmtrs['EN'] = 0.5 * (prmtrs['EN'] + abs(prmtrs['EN']))
+    J = q_elem * gap_area * prmtrs['e'] * mobility(EN) * EN * Td_to_Vm2
+    return voltage - EN * Td_to_Vm2 * neutral_particles * prmtrs['gap_length'] - resistance * J
+
+
+# update for the stochastic solvers (e.g., solve_withN(all_species, parameters, reactions, update=update)):
+# E/N is solved from the circuit only every 1e-8 s or when e changes by more than 0.1 %
+update = constrained_update(circuit, 'EN', interval=1e-8, watched=['e'], bracket=(0.1, 100.0))
 
 parameters['EN'] = voltage / parameters['gap_length'] / gas_density * Vm2_to_Td
 
@@ -68,4 +74,11 @@ reactions[7].rate_fun = reaction_ArpAre
 # diff_rate: diffusion losses
 reactions[10].rate_fun = diff_rate
 reactions[11].rate_fun = diff_rate
-reactions[12].rate_fun = diff_rate
\ No newline at end of file
+reactions[12].rate_fun = diff_rate
+
+
+# -------------------------- SOLVE ------------------------------------
+# E/N is solved from the circuit equation together with the species,
+# the bracket is the range of the tables
+times, values = solve_numerical_constrained(all_species, parameters, reactions, circuit, 'EN', bracket=(0.1, 100.0))
+plot_with_EN(times, values, ['e', 'Ar^+', 'Ar*', 'Ar2^+'], xlog=True)
@@ -0,0 +1,136 @@
+"""
+This file contains the calibration of the stochastic solvers against the deterministic solution.
+
+Instead of guessing the number of superparticles N for solve_withN (or bulk for solve_generic), the deterministic
+reference is computed once by solve_numerical and short stochastic runs with increasingly expensive settings are
+compared to it, until the error of every selected species is below its target. Useful method is:
+ * calibrate
+"""
+import multiprocessing
+import random as rnd
+import time as timer
+
+import numpy as np
+
+from ensemble import log_grid, sample_on_grid
+from solver import solve_numerical, solve_withN, solve_generic
+
+_job = None  # calibration job inherited by the worker processes
+
+
+def calibrate(all_species, parameters, reactions, targets, setting='N', candidates=None, main_specie=None, replicas=4,
+              time_end=None, update=None, reference=None, grid_size=100, processes=None, method='Radau', verbose=False,
+              **solver_kwargs):
+    """
+    Finds the cheapest setting of N (for solve_withN) or bulk (for solve_generic) meeting the error targets.
+
+    For each candidate setting (from the cheapest one), replicas stochastic runs are executed in parallel.
+    The error of a run is the root mean square of the relative difference from the reference on a logarithmic
+    time grid, the error of the candidate is the mean error of its runs (i.e., the expected error of a single
+    production run). The calibration stops at the first candidate meeting all the targets.
+
+    all_species ... is a set of specie names: e.g., {'Ar^+', 'e', 'Ar'}
+    parameters ... is a dictionary containing info parsed from the input file (it is not modified)
+    reactions ... is a list of Reaction objects
+    targets ... dictionary species -> maximal relative error, e.g., {'e': 0.05}
+    setting ... 'N' (solve_withN with parameters['N'] set to the candidate) or 'bulk' (solve_generic with
+        bulk set to the candidate)
+    candidates [optional] ... settings ordered from the cheapest, defaults to increasing N (10 to 10^5),
+        resp. decreasing bulk (from parameters[main_specie] / 10 down by factors of sqrt(10), at most 10 steps,
+        ending with bulk = 1)
+    main_specie [optional] ... for 'N', passed to solve_withN (which defaults to 'e'); for 'bulk', the species
+        setting the scale of the default candidates, defaults to the least abundant species of targets
+    replicas ... number of stochastic runs per candidate
+    time_end [optional] ... end of the calibration runs, defaults to parameters['time_end'] (a shorter time keeps
+        the calibration cheap, the error grows with time only slowly when the dynamics is relaxing)
+    update [optional] ... method update(parameters, time) passed to the solvers
+    reference [optional] ... tuple (times, values) of the deterministic reference, computed by solve_numerical
+        if not specified
+    grid_size ... number of times on which the runs are compared
+    processes [optional] ... number of worker processes, defaults to the number of CPUs; the runs are executed
+        serially if processes is 1 or the platform cannot fork
+    method ... integration method of solve_numerical for the reference
+    verbose ... if True, prints the result for each candidate
+    solver_kwargs ... other keyword arguments passed to the solver (e.g., recompute_N for solve_withN, ERW for
+        solve_generic)
+
+    Returns tuple (recommended, report).
+    recommended ... the cheapest candidate meeting all targets, or None if there is none
+    report ... list of dictionaries with keys 'candidate', 'errors' (dictionary species -> error) and
+        'wall_time' (mean wall time of one run in seconds), one for each tested candidate
+    """
+    global _job
+    if setting not in ('N', 'bulk'):
+        raise ValueError(f"Unknown setting '{setting}', use 'N' or 'bulk'.")
+    parameters = parameters.copy()
+    if time_end is not None:
+        parameters['time_end'] = time_end
+    if candidates is None:
+        if setting == 'N':
+            candidates = [10, 30, 100, 300, 1000, 3000, 10_000, 30_000, 100_000]
+        else:
+            if main_specie is None:
+                main_specie = min(targets, key=lambda specie: parameters[specie])
+            scale = parameters[main_specie] / 10
+            # bulk below 1 would simulate fractions of particles, bulk = 1 (exact simulation) is the last candidate
+            candidates = [scale / np.sqrt(10) ** k for k in range(10) if scale / np.sqrt(10) ** k > 1] + [1]
+    if reference is None:
+        reference = solve_numerical(all_species, parameters.copy(), reactions, update=update, method=method)
+
+    grid = log_grid(parameters['time_ini'], parameters['time_end'], grid_size)
+    reference_on_grid = {specie: np.interp(grid, reference[0], reference[1][specie]) for specie in targets}
+    if setting == 'N' and main_specie is not None:
+        solver_kwargs = dict(solver_kwargs, main_specie=main_specie)
+    _job = (all_species, parameters, reactions, setting, update, solver_kwargs, grid, list(targets))
+
+    if processes != 1 and 'fork' in multiprocessing.get_all_start_methods():
+        # forked workers inherit _job, so the reactions (whose rate functions are lambdas) need not be pickled
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        run = pool.map
+    else:
+        pool = None
+        run = lambda fun, tasks: list(map(fun, tasks))
+
+    report = []
+    recommended = None
+    try:
+        for k, candidate in enumerate(candidates):
+            seeds = [rnd.getrandbits(32) for _ in range(replicas)]
+            results = run(_calibration_run, [(candidate, seed) for seed in seeds])
+            errors = {}
+            for specie in targets:
+                scale = np.maximum(np.abs(reference_on_grid[specie]), 1e-12 * np.abs(reference_on_grid[specie]).max())
+                errors[specie] = float(np.mean([np.sqrt(np.mean(((sampled[specie] - reference_on_grid[specie])
+                                                                 / scale) ** 2)) for sampled, _ in results]))
+            wall_time = float(np.mean([elapsed for _, elapsed in results]))
+            report.append({'candidate': candidate, 'errors': errors, 'wall_time': wall_time})
+            if verbose:
+                print(f"{setting} = {candidate}: errors {errors}, wall time {wall_time} s")
+            if all(errors[specie] <= targets[specie] for specie in targets):
+                recommended = candidate
+                break
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        _job = None
+    return recommended, report
+
+
+def _calibration_run(task):
+    """
+    Executes one stochastic run of the calibration job, returns the tuple (values sampled on the grid, wall time).
+    """
+    candidate, seed = task
+    all_species, parameters, reactions, setting, update, solver_kwargs, grid, species = _job
+    rnd.seed(seed)
+    parameters = parameters.copy()
+    start = timer.perf_counter()
+    if setting == 'N':
+        parameters['N'] = candidate
+        times, values = solve_withN(all_species, parameters, reactions, update=update, **solver_kwargs)
+    else:
+        times, values = solve_generic(all_species, parameters, reactions, update=update, bulk=candidate,
+                                      **solver_kwargs)
+    elapsed = timer.perf_counter() - start
+    return {specie: sample_on_grid(grid, np.array(times), values[specie]) for specie in species}, elapsed
@@ -0,0 +1,253 @@
+"""
+This file contains solvers for mechanisms instantiated in many compartments (cells) coupled by transport.
+
+The mechanism parsed from an input file describes the chemistry of a single cell. The cells are connected by
+a topology (a list of directed pairs of neighbouring cells, see chain_topology for a 1D discharge gap) and
+species hop between neighbours with the given transport rates. The state of all cells is stored in one array of
+shape (cells, species) and all cells are advanced at once. Useful methods are:
+ * chain_topology
+ * solve_compartments_numerical
+ * solve_compartments_stochastic
+
+Reaction rates are evaluated once per step for all cells: rate_fun is called with parameters in which
+the species (and the per-cell parameters given by cell_parameters, e.g. E/N) are numpy arrays over the cells.
+Rates given by constants or tables (and arithmetic on them) work with arrays without any change.
+"""
+import random as rnd
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.sparse import csc_matrix, diags, kron, lil_matrix
+
+from reactions import stoichiometry_matrix, reactant_matrix
+
+
+def chain_topology(n_cells, walls=False):
+    """
+    Returns the topology of a 1D chain of n_cells cells (each cell is connected to its left and right neighbour).
+
+    walls ... if True, the first and the last cell are also connected to None, i.e., particles hopping there
+        leave the domain (losses on the walls)
+    """
+    topology = []
+    for cell in range(n_cells - 1):
+        topology += [(cell, cell + 1), (cell + 1, cell)]
+    if walls:
+        topology += [(0, None), (n_cells - 1, None)]
+    return topology
+
+
+def solve_compartments_numerical(all_species, parameters, reactions, n_cells, topology, transport, initial=None,
+                                 cell_parameters=None, update=None, method='BDF'):
+    """
+    Deterministic solver of the mechanism in n_cells cells coupled by transport.
+
+    all_species ... is a set of specie names: e.g., {'Ar^+', 'e', 'Ar'}
+    parameters ... is a dictionary containing info parsed from the input file, such as time_ini, time_end,
+        initial concentrations (used in every cell unless initial is specified)
+    reactions ... is a list of Reaction objects (i.e. reaction[0] corresponds to the first reaction, stored
+        as instance of the class Reaction specified in reactions.py)
+    n_cells ... number of cells
+    topology ... list of directed pairs (source cell, target cell) of neighbouring cells, target None means
+        leaving the domain (see chain_topology)
+    transport ... dictionary species -> hop rate [1/s] to each neighbour, e.g., {'e': 1e6, 'Ar^+': 1e3},
+        species not listed do not move
+    initial [optional] ... array of shape (n_cells, species) of initial concentrations, the species are ordered
+        as in sorted(all_species)
+    cell_parameters [optional] ... dictionary parameter name -> array of length n_cells of per-cell values
+    update [optional] ... method update(parameters, time) updates any parameters based on the simulation time,
+        it can also set per-cell arrays
+    method ... passed to solve_ivp, a stiff method ('BDF' or 'Radau') makes use of the sparse Jacobian
+
+    Returns tuple (times, values).
+    times ... numpy array of timestamps
+    values ... dictionary of arrays of shape (len(times), n_cells) per species
+    """
+    model = _CompartmentModel(all_species, parameters, reactions, n_cells, topology, transport, initial,
+                              cell_parameters)
+    n = len(model.species)
+
+    def fun(t, y):
+        c = y.reshape(n_cells, n)
+        rates = model.rates(c)
+        dc = model.fluxes(rates, c) @ model.changes.T + model.transport_rhs(c)
+        if update:
+            update(model.parameters, time=t)
+        return dc.ravel()
+
+    def jac(t, y):
+        c = y.reshape(n_cells, n)
+        return model.jacobian(model.rates(c), c)
+
+    time_span = (model.parameters['time_ini'], model.parameters['time_end'])
+    if method in ('BDF', 'Radau'):
+        sol = solve_ivp(fun, time_span, model.initial.ravel(), method=method, jac=jac)
+    else:
+        sol = solve_ivp(fun, time_span, model.initial.ravel(), method=method)
+    states = sol.y.T.reshape(len(sol.t), n_cells, n)
+    values = {specie: states[:, :, i] for i, specie in enumerate(model.species)}
+    return sol.t, values
+
+
+def solve_compartments_stochastic(all_species, parameters, reactions, n_cells, topology, transport, initial=None,
+                                  cell_parameters=None, update=None, bulk=1, epsilon=0.03, seed=None, verbose=False):
+    """
+    Stochastic solver of the mechanism in n_cells cells coupled by transport, using tau-leaping so that
+    all cells are advanced in one vectorized step.
+
+    In each step, the number of executions of every reaction (and transport hop) in every cell is sampled from
+    the Poisson distribution. As in solve_generic, each execution represents bulk reactions. The step tau is chosen
+    so that the expected relative change of each species is at most epsilon; a step producing a negative
+    concentration is rejected and repeated with a halved tau.
+
+    all_species, parameters, reactions, n_cells, topology, transport, initial, cell_parameters, update ... see
+        solve_compartments_numerical (parameters must contain calc_step: the state is stored every calc_step steps)
+    bulk ... number of reactions represented by one execution
+    epsilon ... bound on the relative change of populations in one step
+    seed [optional] ... seed of the numpy generator sampling the Poisson numbers, defaults to random bits drawn
+        from the random module, so that rnd.seed(...) makes the run reproducible as with the other solvers
+    verbose ... if True, prints progress periodically after calc_step steps
+
+    Returns tuple (times, values) in the same format as solve_compartments_numerical.
+    """
+    model = _CompartmentModel(all_species, parameters, reactions, n_cells, topology, transport, initial,
+                              cell_parameters)
+    prmtrs = model.parameters
+    rng = np.random.default_rng(seed if seed is not None else rnd.getrandbits(64))
+    c = model.initial.copy()
+    times = []
+    states = []
+
+    time = prmtrs['time_ini']
+    run = 0
+    while time < prmtrs['time_end']:
+        if run % prmtrs['calc_step'] == 0:
+            if verbose:
+                print(f"run: {run}, time: {time}")
+            times.append(time)
+            states.append(c.copy())
+
+        rates = model.rates(c)
+        a = model.propensities(rates, c)  # (cells, reactions)
+        hops = model.hop_propensities(c)  # (pairs, species)
+        drift = a @ model.changes.T + model.transport_rhs(c)
+        scale = np.maximum(np.abs(c), bulk)
+        with np.errstate(divide='ignore'):
+            tau = epsilon * np.min(scale / np.abs(drift))
+        if not np.isfinite(tau):
+            raise ZeroDivisionError("There is no possible reaction given the particle concentrations.")
+        tau = min(tau, prmtrs['time_end'] - time)
+
+        while True:
+            fired = rng.poisson(a * tau / bulk) * bulk
+            hopped = rng.poisson(hops * tau / bulk) * bulk
+            new_c = c + fired @ model.changes.T + model.apply_hops(hopped)
+            if np.all(new_c >= 0):
+                break
+            tau /= 2
+        c = new_c
+        time += tau
+
+        if update:
+            update(prmtrs, time=time)
+        run += 1
+
+    times.append(time)
+    states.append(c.copy())
+    states = np.array(states)
+    values = {specie: states[:, :, i] for i, specie in enumerate(model.species)}
+    return np.array(times), values
+
+
+class _CompartmentModel:
+    """
+    Vectorized mass action kinetics and transport of the mechanism in all cells.
+    """
+
+    def __init__(self, all_species, parameters, reactions, n_cells, topology, transport, initial, cell_parameters):
+        self.species = sorted(all_species)
+        self.reactions = reactions
+        self.n_cells = n_cells
+        self.changes = stoichiometry_matrix(self.species, reactions)  # (species, reactions)
+        self.orders = reactant_matrix(self.species, reactions)
+
+        self.parameters = parameters.copy()
+        if cell_parameters:
+            for name, cell_values in cell_parameters.items():
+                self.parameters[name] = np.asarray(cell_values, dtype=float)
+
+        if initial is None:
+            initial = np.tile([float(parameters[specie]) for specie in self.species], (n_cells, 1))
+        self.initial = np.asarray(initial, dtype=float)
+
+        self.sources = np.array([source for source, target in topology])
+        # hop matrix: (cells, pairs), a hop along the pair removes a particle from the source and adds it to the target
+        hop_matrix = lil_matrix((n_cells, len(topology)))
+        for k, (source, target) in enumerate(topology):
+            hop_matrix[source, k] -= 1
+            if target is not None:
+                hop_matrix[target, k] += 1
+        self.hop_matrix = hop_matrix.tocsr()
+        self.hop_rates = np.array([transport.get(specie, 0) for specie in self.species], dtype=float)
+        # transport operator acting on one species column: sum over pairs of hop_matrix[:, pair] * c[source]
+        self.laplacian = (self.hop_matrix @ csc_matrix((np.ones(len(topology)),
+                                                        (np.arange(len(topology)), self.sources)),
+                                                       shape=(len(topology), n_cells))).tocsc()
+
+    def rates(self, c):
+        """
+        Rate of each reaction in each cell as an array of shape (cells, reactions). The species in parameters are
+        set to the concentrations c first, so the rates can depend on them.
+        """
+        for i, specie in enumerate(self.species):
+            self.parameters[specie] = c[:, i]
+        rates = np.empty((self.n_cells, len(self.reactions)))
+        for j, reaction in enumerate(self.reactions):
+            rates[:, j] = reaction.rate_fun(self.parameters)
+        return rates
+
+    def fluxes(self, rates, c):
+        """
+        Deterministic mass action fluxes (cells, reactions).
+        """
+        return rates * np.prod(c[:, :, np.newaxis] ** self.orders[np.newaxis, :, :], axis=1)
+
+    def propensities(self, rates, c):
+        """
+        Transition rates (cells, reactions) computed the same way as Reaction.compute_a.
+        """
+        a = rates.copy()
+        for j in range(len(self.reactions)):
+            for i in np.flatnonzero(self.orders[:, j]):
+                for k in range(int(self.orders[i, j])):
+                    a[:, j] *= c[:, i] - k
+        return np.maximum(a, 0)
+
+    def transport_rhs(self, c):
+        return (self.laplacian @ c) * self.hop_rates
+
+    def hop_propensities(self, c):
+        return c[self.sources] * self.hop_rates
+
+    def apply_hops(self, hopped):
+        return self.hop_matrix @ hopped
+
+    def jacobian(self, rates, c):
+        """
+        Sparse Jacobian of the right-hand side with respect to the flattened state (cell by cell).
+        """
+        n = len(self.species)
+        # derivative of the flux of each reaction with respect to each concentration (cells, reactions, species)
+        flux_derivatives = np.zeros((self.n_cells, len(self.reactions), n))
+        for j in range(len(self.reactions)):
+            for i in np.flatnonzero(self.orders[:, j]):
+                derivative = rates[:, j] * self.orders[i, j] * c[:, i] ** (self.orders[i, j] - 1)
+                for other in np.flatnonzero(self.orders[:, j]):
+                    if other != i:
+                        derivative = derivative * c[:, other] ** self.orders[other, j]
+                flux_derivatives[:, j, i] = derivative
+        blocks = np.einsum('sr,crn->csn', self.changes, flux_derivatives)
+        cells, rows, cols = np.meshgrid(np.arange(self.n_cells), np.arange(n), np.arange(n), indexing='ij')
+        chemistry = csc_matrix((blocks.ravel(), ((cells * n + rows).ravel(), (cells * n + cols).ravel())),
+                               shape=(self.n_cells * n, self.n_cells * n))
+        return (chemistry + kron(self.laplacian, diags(self.hop_rates))).tocsc()
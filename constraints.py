@@ -0,0 +1,142 @@
+"""
+This file contains the support for algebraic constraints coupled to the mechanism, such as the reduced electric
+field E/N given by an external circuit (see MicroCathode/micro_cathode_selfconsistent.py).
+
+A constraint is a function constraint(value, parameters) returning the residual of the algebraic equation for the
+parameter name (e.g., 'EN') given the current concentrations in parameters. Instead of a fixed-point update after
+every event, the equation is solved exactly:
+ * solve_numerical_constrained ... deterministic solver of the index-reduced DAE: the algebraic variable is
+    eliminated by solving the constraint in every evaluation of the right-hand side, so the stiff integrator sees
+    a consistent ODE system and can take large steps
+ * constrained_update ... update method for the stochastic solvers re-solving the constraint only once per time
+    interval or after the watched species change enough
+"""
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import brentq, newton
+
+from reactions import stoichiometry_matrix, reactant_matrix, mass_action_fluxes
+
+
+def solve_constraint(constraint, parameters, name, guess=None, bracket=None, rtol=1e-10):
+    """
+    Solves constraint(value, parameters) = 0 for the value of the parameter name and stores it into parameters.
+
+    The secant method is started from guess (defaults to the current value of the parameter). If it fails, or
+    leaves the bracket, the bracketing (Brent) method is used on the bracket.
+
+    constraint ... function constraint(value, parameters) returning the residual
+    parameters ... dictionary of parameters including the current concentrations
+    name ... name of the solved parameter, e.g., 'EN'
+    guess [optional] ... initial guess
+    bracket [optional] ... tuple (low, high) of values with residuals of opposite signs (e.g., the range of
+        the tables used by the rates)
+    rtol ... relative tolerance of the solution
+
+    Returns the solution.
+    """
+    if guess is None:
+        guess = parameters[name]
+    value = None
+    try:
+        value = newton(lambda x: constraint(x, parameters), guess, rtol=rtol, maxiter=50)
+        if not np.isfinite(value) or (bracket and not bracket[0] <= value <= bracket[1]):
+            value = None
+    except (RuntimeError, ValueError, ZeroDivisionError):
+        value = None
+    if value is None:
+        if not bracket:
+            raise ValueError(f"The constraint for '{name}' could not be solved from the guess {guess}, "
+                             f"specify the bracket.")
+        value = brentq(lambda x: constraint(x, parameters), bracket[0], bracket[1], rtol=rtol)
+    parameters[name] = float(value)
+    return parameters[name]
+
+
+def solve_numerical_constrained(all_species, parameters, reactions, constraint, name, bracket=None, update=None,
+                                method='Radau'):
+    """
+    Deterministic solver with the parameter name (e.g., 'EN') given implicitly by constraint(value, parameters) = 0.
+
+    In every evaluation of the right-hand side, the concentrations are stored into parameters, the constraint is
+    solved for the parameter (starting from its previous value, see solve_constraint) and the reaction rates are
+    evaluated with it.
+
+    all_species ... is a set of specie names: e.g., {'Ar^+', 'e', 'Ar'}
+    parameters ... is a dictionary containing info parsed from the input file, such as time_ini, time_end,
+        initial concentrations and an initial guess of the parameter name; it is not modified (the solver works
+        on its copy), so it can be reused for another run
+    reactions ... is a list of Reaction objects
+    constraint ... function constraint(value, parameters) returning the residual of the algebraic equation
+    name ... name of the parameter determined by the constraint
+    bracket [optional] ... passed to solve_constraint
+    update [optional] ... method update(parameters, time) setting other time dependent parameters (it is called
+        with the copy of parameters)
+    method ... passed to solve_ivp, stiff methods ('Radau', 'BDF') allow large steps
+
+    Returns tuple (times, values) in the same format as solve_numerical, values also contain the parameter name.
+    """
+    all_species = list(all_species)  # species need to be in an (any) order (deals with Set)
+    parameters = parameters.copy()
+    changes = stoichiometry_matrix(all_species, reactions)
+    orders = reactant_matrix(all_species, reactions)
+
+    def consistent_rates(t, concentrations):
+        if update:
+            update(parameters, time=t)
+        for i, specie in enumerate(all_species):
+            parameters[specie] = concentrations[i]
+        solve_constraint(constraint, parameters, name, bracket=bracket)
+        return np.array([reaction.rate_fun(parameters) for reaction in reactions], dtype=float)
+
+    def fun(t, concentrations):
+        return changes @ mass_action_fluxes(orders, consistent_rates(t, concentrations), concentrations)
+
+    initial_concentrations = np.array([parameters[specie] for specie in all_species], dtype=float)
+    sol = solve_ivp(fun, (parameters['time_ini'], parameters['time_end']), initial_concentrations, method=method)
+    values = {all_species[i]: sol.y[i] for i in range(len(all_species))}
+
+    # the algebraic variable at the output times
+    values[name] = np.empty(len(sol.t))
+    for k, t in enumerate(sol.t):
+        consistent_rates(t, sol.y[:, k])
+        values[name][k] = parameters[name]
+    return sol.t, values
+
+
+def constrained_update(constraint, name, interval, watched=(), rtol=1e-3, bracket=None, update=None):
+    """
+    Creates an update method for the stochastic solvers (solve_generic, solve_withN) keeping the parameter name
+    consistent with the constraint.
+
+    The constraint is solved exactly (see solve_constraint), but only when the time since the last solution
+    exceeds interval, or when any of the watched species changed by more than rtol relatively, so most events
+    only cost a comparison.
+
+    constraint ... function constraint(value, parameters) returning the residual of the algebraic equation
+    name ... name of the parameter determined by the constraint, e.g., 'EN'
+    interval ... time after which the constraint is solved again even if no watched species changed, it must be
+        positive (it should be short compared to the time scale of the circuit, but long compared to the time
+        between events, otherwise the constraint is solved after every event)
+    watched ... species whose relative change by more than rtol triggers the solution, e.g., ['e']
+    rtol ... relative change of the watched species triggering the solution
+    bracket [optional] ... passed to solve_constraint
+    update [optional] ... other update method called before (e.g., setting a time dependent voltage)
+
+    Returns the update method update(parameters, time).
+    """
+    if interval <= 0:
+        raise ValueError(f"The interval must be positive, got {interval}.")
+    last = {'time': None, 'watched': None}
+
+    def constrained(parameters, time):
+        if update:
+            update(parameters, time=time)
+        current = np.array([parameters[specie] for specie in watched], dtype=float)
+        if last['time'] is None or time - last['time'] >= interval or \
+                np.any(np.abs(current - last['watched']) > rtol * np.abs(last['watched'])):
+            solve_constraint(constraint, parameters, name, bracket=bracket)
+            last['time'] = time
+            last['watched'] = current
+
+    return constrained
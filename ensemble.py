@@ -0,0 +1,224 @@
+"""
+This file contains streaming statistics of an ensemble of stochastic trajectories on a common time grid.
+
+Each trajectory is sampled on the grid (as a piecewise constant function of time) and immediately folded into
+the running mean and variance (Welford's algorithm) and into a quantile sketch. Nothing else is stored, so
+the memory stays constant in the number of trajectories. Statistics from different workers can be merged.
+Useful methods are:
+ * log_grid
+ * sample_on_grid
+ * EnsembleStatistics
+
+Example (one replica of solve_generic, without storing its trajectory):
+    statistics = EnsembleStatistics(log_grid(1e-9, 1e-3, 1000), all_species)
+    tracker = statistics.tracker(parameters, update=update)
+    solve_generic(all_species, parameters, reactions, update=tracker.update, outfile=os.devnull)
+    tracker.finish()
+(for solve_withN, use statistics.tracker(parameters, update=update, time_before_event=True))
+"""
+import numpy as np
+
+
+def log_grid(time_ini, time_end, num):
+    """
+    Returns num logarithmically spaced times between time_ini and time_end. If time_ini is not positive,
+    the first time is time_ini and the others are spaced logarithmically from time_end * 1e-9.
+    """
+    if time_ini > 0:
+        return np.logspace(np.log10(time_ini), np.log10(time_end), num)
+    return np.concatenate([[time_ini], np.logspace(np.log10(time_end * 1e-9), np.log10(time_end), num - 1)])
+
+
+def sample_on_grid(grid, times, ys):
+    """
+    Samples a piecewise constant trajectory (times, ys) at grid times (the last value before or at each grid time,
+    grid times before the first timestamp get the first value).
+    """
+    indices = np.searchsorted(times, grid, side='right') - 1
+    return np.asarray(ys, dtype=float)[np.clip(indices, 0, len(times) - 1)]
+
+
+class EnsembleStatistics:
+    """
+    Running statistics of an ensemble of trajectories on a common time grid.
+
+    grid ... increasing array of times
+    species ... names of the tracked species (or other parameters, e.g., 'EN')
+    relative_accuracy ... relative accuracy of the quantiles: the quantile sketch stores logarithmically spaced
+        histograms (with the bin ratio (1 + relative_accuracy) / (1 - relative_accuracy)) per grid point,
+        values that are not positive are counted in a separate bin and reported as 0
+
+    Attributes:
+        count -- number of trajectories added
+    """
+
+    def __init__(self, grid, species, relative_accuracy=0.01):
+        self.grid = np.asarray(grid, dtype=float)
+        self.species = list(species)
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.count = 0
+        self._mean = {specie: np.zeros(len(self.grid)) for specie in self.species}
+        self._m2 = {specie: np.zeros(len(self.grid)) for specie in self.species}
+        self._zeros = {specie: np.zeros(len(self.grid), dtype=np.int64) for specie in self.species}
+        self._bins = {specie: np.zeros((len(self.grid), 0), dtype=np.int64) for specie in self.species}
+        self._offset = {specie: 0 for specie in self.species}
+
+    def add(self, times, values):
+        """
+        Adds one trajectory: times is a list of timestamps and values a dictionary of lists as returned
+        by the solvers from solver.py.
+        """
+        times = np.asarray(times, dtype=float)
+        self.add_sampled({specie: sample_on_grid(self.grid, times, values[specie]) for specie in self.species})
+
+    def add_sampled(self, sampled):
+        """
+        Adds one trajectory already sampled on the grid: sampled is a dictionary species -> array of len(grid).
+        """
+        self.count += 1
+        for specie in self.species:
+            x = np.asarray(sampled[specie], dtype=float)
+            delta = x - self._mean[specie]
+            self._mean[specie] += delta / self.count
+            self._m2[specie] += delta * (x - self._mean[specie])
+            self._add_to_sketch(specie, x)
+
+    def tracker(self, parameters, update=None, time_before_event=False):
+        """
+        Returns a _ReplicaTracker collecting one trajectory while a solver runs, so that the trajectory does not
+        need to be stored. Its method update must be passed as the update argument of the solver; it records
+        the state and calls the original update method. The initial state is taken from parameters at time_ini.
+
+        time_before_event ... solve_generic calls update with the time of the event, solve_withN with the time
+            before the event (time - tau), set it to True for solve_withN
+        """
+        return _ReplicaTracker(self, parameters, update, time_before_event)
+
+    def merge(self, other):
+        """
+        Merges statistics of another ensemble on the same grid (e.g., computed by another worker) into this one.
+        """
+        if not np.array_equal(self.grid, other.grid) or self.species != other.species \
+                or self.gamma != other.gamma:
+            raise ValueError("Only statistics with the same grid, species and accuracy can be merged.")
+        total = self.count + other.count
+        if total == 0:
+            return self
+        for specie in self.species:
+            delta = other._mean[specie] - self._mean[specie]
+            self._m2[specie] += other._m2[specie] + delta ** 2 * self.count * other.count / total
+            self._mean[specie] += delta * other.count / total
+            self._zeros[specie] += other._zeros[specie]
+            if other._bins[specie].shape[1]:
+                low = other._offset[specie]
+                self._reserve_bins(specie, low, low + other._bins[specie].shape[1] - 1)
+                start = low - self._offset[specie]
+                self._bins[specie][:, start:start + other._bins[specie].shape[1]] += other._bins[specie]
+        self.count = total
+        return self
+
+    def mean(self, specie):
+        return self._mean[specie].copy()
+
+    def variance(self, specie):
+        """
+        Sample variance (zero if there are less than two trajectories).
+        """
+        if self.count < 2:
+            return np.zeros(len(self.grid))
+        return self._m2[specie] / (self.count - 1)
+
+    def std(self, specie):
+        return np.sqrt(self.variance(specie))
+
+    def quantile(self, specie, q):
+        """
+        Approximate q-quantile (0 <= q <= 1) of the species at each grid time.
+        """
+        if self.count == 0:
+            raise ValueError("There are no trajectories in the ensemble.")
+        rank = q * (self.count - 1)
+        cumulative = self._zeros[specie][:, np.newaxis] + np.cumsum(self._bins[specie], axis=1)
+        result = np.zeros(len(self.grid))
+        positive = self._zeros[specie] <= rank  # otherwise the quantile is in the bin of non-positive values
+        if cumulative.shape[1]:
+            indices = np.argmax(cumulative > rank, axis=1) + self._offset[specie]
+            result[positive] = 2 * self.gamma ** indices[positive] / (self.gamma + 1)
+        return result
+
+    def result(self):
+        """
+        Returns the tuple (grid, means) in the same format as returned by the solvers from solver.py.
+        """
+        return self.grid, {specie: self.mean(specie) for specie in self.species}
+
+    def _add_to_sketch(self, specie, x):
+        positive = x > 0
+        self._zeros[specie] += ~positive
+        if not positive.any():
+            return
+        indices = np.ceil(np.log(x[positive]) / np.log(self.gamma)).astype(np.int64)
+        self._reserve_bins(specie, indices.min(), indices.max())
+        self._bins[specie][np.flatnonzero(positive), indices - self._offset[specie]] += 1
+
+    def _reserve_bins(self, specie, low, high):
+        """
+        Extends the histogram of the species so that it contains the bins low to high.
+        """
+        bins = self._bins[specie]
+        if bins.shape[1] == 0:
+            self._bins[specie] = np.zeros((len(self.grid), high - low + 1), dtype=np.int64)
+            self._offset[specie] = low
+            return
+        offset = self._offset[specie]
+        before = max(offset - low, 0)
+        after = max(high - (offset + bins.shape[1] - 1), 0)
+        if before or after:
+            self._bins[specie] = np.pad(bins, ((0, 0), (before, after)))
+            self._offset[specie] = offset - before
+
+
+class _ReplicaTracker:
+    """
+    Samples one running trajectory on the grid of EnsembleStatistics (see EnsembleStatistics.tracker).
+
+    If not time_before_event, the time passed to update is the time since which the new state holds. Otherwise,
+    it is the time since which the state of the previous call holds, so the new state is kept pending until
+    the next call.
+    """
+
+    def __init__(self, statistics, parameters, update, time_before_event=False):
+        self.statistics = statistics
+        self.original_update = update
+        self.time_before_event = time_before_event
+        self.sampled = np.empty((len(statistics.species), len(statistics.grid)))
+        self.position = 0  # the first grid point not filled yet
+        self.state = self._state(parameters)
+        self.pending = None  # the state whose starting time is not known yet (if time_before_event)
+
+    def update(self, parameters, time):
+        # grid points before this time still had the previous state
+        end = np.searchsorted(self.statistics.grid, time, side='left')
+        if end > self.position:
+            self.sampled[:, self.position:end] = self.state[:, np.newaxis]
+            self.position = end
+        if self.original_update: self.original_update(parameters, time=time)
+        if not self.time_before_event:
+            self.state = self._state(parameters)
+            return
+        if self.pending is not None:
+            self.state = self.pending
+        self.pending = self._state(parameters)
+
+    def finish(self):
+        """
+        Fills the rest of the grid with the last state and adds the trajectory to the statistics (a pending state
+        of the last event is not used, the solvers do not record it either).
+        """
+        self.sampled[:, self.position:] = self.state[:, np.newaxis]
+        self.position = len(self.statistics.grid)
+        self.statistics.add_sampled(dict(zip(self.statistics.species, self.sampled)))
+
+    def _state(self, parameters):
+        return np.array([parameters[specie] for specie in self.statistics.species], dtype=float)
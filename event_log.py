@@ -0,0 +1,240 @@
+"""
+This file contains the compact reaction-event log, an alternative way of recording stochastic simulations.
+
+Instead of storing all species every calc_step iterations, the solver records only the index of the executed
+reaction, its weight and the time delta of every event. The events are packed into numpy arrays and compressed
+in chunks (zlib). Any species trajectory at any resolution, or the statistics of reaction fluxes, are then
+reconstructed later by replaying the log against the initial state, without running the simulation again.
+
+Example:
+    log = EventLog(all_species, parameters, reactions, filename='run.events')
+    solve_generic(all_species, parameters, reactions, event_log=log)
+    log.close()
+    times, values = EventLog.load('run.events').trajectory(['e'], times=np.logspace(-9, -3, 1000))
+
+The replay only knows the reactions, so it is exact only if the update method does not change the species
+(e.g., replenishing reservoirs); other parameters, such as EN, may be changed freely.
+"""
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from reactions import stoichiometry_matrix
+
+_MAGIC = b'EVLOG1\n'
+
+
+class EventLog:
+    """
+    Compact log of reaction events (see the description of this file).
+
+    all_species ... is a set of specie names
+    parameters ... is a dictionary containing info parsed from the input file, the initial state and time_ini
+        are taken from it, so the log must be created before the solver starts
+    reactions ... is a list of Reaction objects
+    filename [optional] ... if specified, the chunks are written into this file, otherwise they are kept in memory
+    chunk_size ... number of events per compressed chunk
+    time_dtype ... numpy type of the stored time deltas, float32 halves the size (with the relative precision
+        of 1e-7 of each delta), use float64 for exact times
+    """
+
+    def __init__(self, all_species, parameters, reactions, filename=None, chunk_size=65_536, time_dtype=np.float32):
+        self.species = sorted(all_species)
+        self.initial = np.array([parameters[specie] for specie in self.species], dtype=float)
+        self.time_ini = float(parameters['time_ini'])
+        self.changes = stoichiometry_matrix(self.species, reactions)  # (species, reactions)
+        self.reaction_names = [str(reaction) for reaction in reactions]
+        self.index_dtype = np.dtype(np.uint8 if len(reactions) <= 256 else np.uint16)
+        self.time_dtype = np.dtype(time_dtype)
+        self.chunk_size = chunk_size
+        self.chunks = []  # compressed chunks kept in memory (if there is no file)
+        self.filename = filename
+        self._file = None
+        if filename:
+            self._file = open(filename, 'wb')
+            self._file.write(_MAGIC)
+            header = json.dumps(self._header()).encode()
+            self._file.write(struct.pack('<I', len(header)) + header)
+        self._reset_buffer()
+
+    def record(self, reaction_index, weight, tau):
+        """
+        Records one event: the index of the executed reaction, its weight (bulk) and the time delta.
+        """
+        position = self._count
+        self._indices[position] = reaction_index
+        self._weights[position] = weight
+        self._taus[position] = tau
+        self._count += 1
+        if self._count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Compresses the buffered events into a chunk (called by the solvers at the end of the simulation).
+        """
+        if self._count == 0:
+            return
+        n = self._count
+        parts = [zlib.compress(array[:n].tobytes()) for array in (self._indices, self._weights, self._taus)]
+        chunk = struct.pack('<IIII', n, *[len(part) for part in parts]) + b''.join(parts)
+        if self._file:
+            self._file.write(chunk)
+            self._file.flush()
+        else:
+            self.chunks.append(chunk)
+        self._reset_buffer()
+
+    def close(self):
+        self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def load(filename):
+        """
+        Loads an event log written into a file. The returned log is read-only (it can only be replayed).
+        """
+        log = EventLog.__new__(EventLog)
+        with open(filename, 'rb') as file:
+            if file.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"The file '{filename}' is not an event log.")
+            header_size, = struct.unpack('<I', file.read(4))
+            header = json.loads(file.read(header_size).decode())
+            data = file.read()
+        log.species = header['species']
+        log.initial = np.array(header['initial'], dtype=float)
+        log.time_ini = header['time_ini']
+        log.changes = np.array(header['changes'], dtype=float).reshape(len(log.species), -1)
+        log.reaction_names = header['reactions']
+        log.index_dtype = np.dtype(header['index_dtype'])
+        log.time_dtype = np.dtype(header['time_dtype'])
+        log.chunk_size = None
+        log.filename = filename
+        log._file = None
+        log.chunks = []
+        position = 0
+        while position < len(data):
+            sizes = struct.unpack('<IIII', data[position:position + 16])
+            end = position + 16 + sum(sizes[1:])
+            log.chunks.append(data[position:end])
+            position = end
+        log._count = 0
+        return log
+
+    def events(self):
+        """
+        Generator of the decompressed chunks: tuples (reaction indices, weights, time deltas) of numpy arrays.
+        """
+        for chunk in self.chunks:
+            n, *sizes = struct.unpack('<IIII', chunk[:16])
+            position = 16
+            arrays = []
+            for size, dtype in zip(sizes, (self.index_dtype, np.dtype(float), self.time_dtype)):
+                arrays.append(np.frombuffer(zlib.decompress(chunk[position:position + size]), dtype=dtype))
+                position += size
+            yield arrays[0], arrays[1], arrays[2].astype(float)
+
+    def trajectory(self, selected_species=None, times=None, every=None, initial=None):
+        """
+        Reconstructs trajectories of the selected species by replaying the log.
+
+        selected_species [optional] ... species to be reconstructed, defaults to all species
+        times [optional] ... increasing times at which the (piecewise constant) trajectory is sampled
+        every [optional] ... if times is not specified, the state is returned after every every-th event
+            (i.e., the same as calc_step of the solvers), defaults to 1
+        initial [optional] ... dictionary of initial concentrations (e.g., parameters from parse_input_file),
+            defaults to the initial state stored in the log
+
+        Returns tuple (times, values) in the same format as returned by the solvers from solver.py.
+        """
+        if selected_species is None:
+            selected_species = self.species
+        rows = [self.species.index(specie) for specie in selected_species]
+        state = self._initial_state(initial)[rows]
+        changes = self.changes[rows]  # (selected species, reactions)
+        time = self.time_ini
+        if times is not None:
+            times = np.asarray(times, dtype=float)
+            sampled = np.empty((len(times), len(rows)))
+            filled = np.searchsorted(times, time, side='left')  # the grid times before time_ini
+            sampled[:filled] = state
+        else:
+            every = every or 1
+            out_times = [np.array([time])]
+            out_states = [state[np.newaxis, :]]
+            event_number = 0
+
+        for indices, weights, taus in self.events():
+            event_times = time + np.cumsum(taus)
+            states = state + np.cumsum(changes[:, indices].T * weights[:, np.newaxis], axis=0)
+            if times is not None:
+                # grid times before the end of this chunk get the state after the last event preceding them
+                end = np.searchsorted(times, event_times[-1], side='right')
+                positions = np.searchsorted(event_times, times[filled:end], side='right') - 1
+                sampled[filled:end] = np.where(positions[:, np.newaxis] >= 0,
+                                               states[np.maximum(positions, 0)], state)
+                filled = end
+            else:
+                selected = np.arange(event_number, event_number + len(indices))
+                selected = np.flatnonzero((selected + 1) % every == 0)
+                out_times.append(event_times[selected])
+                out_states.append(states[selected])
+                event_number += len(indices)
+            time = event_times[-1]
+            state = states[-1]
+
+        if times is not None:
+            sampled[filled:] = state
+            return times, {specie: sampled[:, k] for k, specie in enumerate(selected_species)}
+        out_states = np.concatenate(out_states)
+        return np.concatenate(out_times), {specie: out_states[:, k] for k, specie in enumerate(selected_species)}
+
+    def reaction_statistics(self, times=None):
+        """
+        Computes the number of executed reactions (sum of the weights of the events) of each reaction.
+
+        times [optional] ... increasing edges of time intervals, if specified, the statistics are computed
+            per interval
+
+        Returns tuple (executed, fluxes) of numpy arrays: executed is the number of executed reactions of shape
+        (reactions,) or (intervals, reactions), fluxes is executed divided by the duration (of the whole log,
+        resp. of the intervals), i.e., the mean reaction rates.
+        """
+        n_reactions = self.changes.shape[1]
+        time = self.time_ini
+        if times is None:
+            executed = np.zeros(n_reactions)
+            for indices, weights, taus in self.events():
+                executed += np.bincount(indices, weights=weights, minlength=n_reactions)
+                time += taus.sum()
+            duration = time - self.time_ini
+            return executed, executed / duration if duration > 0 else executed * np.nan
+        times = np.asarray(times, dtype=float)
+        executed = np.zeros((len(times) - 1, n_reactions))
+        for indices, weights, taus in self.events():
+            event_times = time + np.cumsum(taus)
+            intervals = np.searchsorted(times, event_times, side='right') - 1
+            inside = (intervals >= 0) & (intervals < len(times) - 1)
+            np.add.at(executed, (intervals[inside], indices[inside].astype(np.intp)), weights[inside])
+            time = event_times[-1]
+        return executed, executed / np.diff(times)[:, np.newaxis]
+
+    def _initial_state(self, initial):
+        if initial is None:
+            return self.initial
+        return np.array([initial[specie] for specie in self.species], dtype=float)
+
+    def _header(self):
+        return {'species': self.species, 'initial': self.initial.tolist(), 'time_ini': self.time_ini,
+                'changes': self.changes.ravel().tolist(), 'reactions': self.reaction_names,
+                'index_dtype': self.index_dtype.str, 'time_dtype': self.time_dtype.str}
+
+    def _reset_buffer(self):
+        self._indices = np.empty(self.chunk_size, dtype=self.index_dtype)
+        self._weights = np.empty(self.chunk_size, dtype=float)
+        self._taus = np.empty(self.chunk_size, dtype=self.time_dtype)
+        self._count = 0
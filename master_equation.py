@@ -0,0 +1,210 @@
+"""
+This file contains the finite state projection (FSP) solver of the chemical master equation.
+
+Instead of estimating the probability distribution of the species populations from many stochastic trajectories
+(see solve_generic in solver.py), it computes the distribution directly. It is only usable for small populations,
+as every reachable state of the system is enumerated. Useful methods are:
+ * solve_fsp
+ * marginal_distribution
+"""
+import warnings
+
+import numpy as np
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import expm_multiply
+
+from reactions import stoichiometry_matrix, reactant_matrix
+
+
+def solve_fsp(all_species, parameters, reactions, times=None, tolerance=1e-4, fixed_species=(), expansion=10,
+              max_states=1_000_000, verbose=False):
+    """
+    Solves the chemical master equation by the finite state projection with adaptive expansion.
+
+    The state space is the set of states reachable from the initial state (given by parameters) within the bounds
+    on each species population. Probability leaving the bounds is collected in a sink state for each species;
+    the total sink probability is an upper bound of the error of the computed distribution (in the L1 norm).
+    Whenever it exceeds tolerance at the final time, the bounds of the escaping species are enlarged and the
+    computation is repeated.
+
+    Reaction rates are evaluated once from parameters (rate_fun must not depend on time, there is no update).
+
+    all_species ... is a set of specie names: e.g., {'X', 'Y', 'A'}
+    parameters ... is a dictionary containing info parsed from the input file, such as time_ini,
+        initial (integer) populations
+    reactions ... is a list of Reaction objects (i.e. reaction[0] corresponds to the first reaction, stored
+        as instance of the class Reaction specified in reactions.py)
+    times [optional] ... times at which the distribution is returned, defaults to 100 times between time_ini
+        and time_end
+    tolerance ... maximal allowed probability lost from the projection at the final time
+    fixed_species ... species kept constant at their value in parameters and left out of the state space: reservoirs
+        (such as A, B in the Brusselator, which are replenished by an update method) and sinks that are not
+        reactants of any reaction (such as e(W)), which would otherwise enlarge the state space needlessly
+    expansion ... initial margin above the initial populations, and the minimal enlargement of a bound
+    max_states ... the expansion stops (with a warning) if the projection would have more states than this
+    verbose ... if True, prints out the size of the projection and its error after each expansion
+
+    Returns tuple (times, values, distribution).
+    times ... numpy array of times
+    values ... dictionary of mean populations at times, e.g., {'X': [...], 'Y': [...]}, in the same format
+        as returned by the solvers from solver.py
+    distribution ... dictionary with keys 'species' (ordered list of species in the state space), 'states'
+        (numpy array of shape (number of states, number of species)), 'probabilities' (numpy array of shape
+        (len(times), number of states)) and 'error' (the final sink probability)
+    """
+    species = [specie for specie in all_species if specie not in fixed_species]
+    if times is None:
+        times = np.linspace(parameters['time_ini'], parameters['time_end'], 100)
+    times = np.asarray(times, dtype=float)
+
+    initial_state = np.array([parameters[specie] for specie in species], dtype=float)
+    if np.any(initial_state != np.round(initial_state)) or np.any(initial_state < 0):
+        raise ValueError("The finite state projection requires non-negative integer initial populations.")
+    initial_state = initial_state.astype(np.int64)
+
+    changes = stoichiometry_matrix(species, reactions).T.astype(np.int64)  # (reactions, species)
+    orders = reactant_matrix(species, reactions).T.astype(np.int64)
+    rates = np.array([_fixed_rate(reaction, parameters, fixed_species) for reaction in reactions])
+
+    upper = initial_state + expansion
+    while True:
+        states, generator = _build_generator(initial_state, upper, changes, orders, rates)
+        if verbose:
+            print(f"projection bounds: {dict(zip(species, upper))}, states: {len(states)}")
+        probabilities = _propagate(generator, len(states), parameters['time_ini'], times)
+        sinks = probabilities[-1, len(states):]
+        error = sinks.sum()
+        if verbose:
+            print(f"error: {error}")
+        if error <= tolerance:
+            break
+
+        # enlarge the bounds of the species through which the probability escapes
+        new_upper = upper.copy()
+        for i in range(len(species)):
+            if sinks[i] > tolerance / len(species):
+                new_upper[i] += max(expansion, upper[i] // 2)
+        if _count_states(initial_state, new_upper, changes, orders, rates, max_states) > max_states:
+            warnings.warn(f"The finite state projection reached max_states={max_states} with error {error} "
+                          f"above the tolerance {tolerance}.", UserWarning)
+            break
+        upper = new_upper
+
+    probabilities = probabilities[:, :len(states)]
+    values = {specie: probabilities @ states[:, i] for i, specie in enumerate(species)}
+    for specie in fixed_species:
+        if specie in all_species:
+            values[specie] = np.full(len(times), parameters[specie], dtype=float)
+    distribution = {'species': species, 'states': states, 'probabilities': probabilities, 'error': error}
+    return times, values, distribution
+
+
+def marginal_distribution(distribution, specie, time_index=-1):
+    """
+    Computes the marginal distribution of a single species from the distribution returned by solve_fsp.
+
+    distribution ... third item of the tuple returned by solve_fsp
+    specie ... name of the species
+    time_index ... index into the times returned by solve_fsp (defaults to the final time)
+
+    Returns tuple (populations, probabilities) of numpy arrays.
+    """
+    column = distribution['states'][:, distribution['species'].index(specie)]
+    probabilities = np.bincount(column, weights=distribution['probabilities'][time_index])
+    return np.arange(len(probabilities)), probabilities
+
+
+def _fixed_rate(reaction, parameters, fixed_species):
+    """
+    Rate of the reaction including the (constant) contribution of the fixed species to its transition rate.
+    """
+    rate = reaction.rate_fun(parameters)
+    for reactant in reaction.reactants:
+        if reactant in fixed_species:
+            for i in range(reaction.reactants[reactant]):
+                rate *= parameters[reactant] - i
+    return max(rate, 0)
+
+
+def _propensities(states, orders, rates):
+    """
+    Transition rates of all reactions in all states as an array of shape (len(states), len(rates)), computed
+    the same way as Reaction.compute_a.
+    """
+    a = np.tile(rates.astype(float), (len(states), 1))
+    for j in range(len(rates)):
+        for i in np.flatnonzero(orders[j]):
+            for k in range(orders[j, i]):
+                a[:, j] *= states[:, i] - k
+    return np.maximum(a, 0)
+
+
+def _enumerate_states(initial_state, upper, changes, orders, rates, max_states=None):
+    """
+    Breadth-first enumeration of the states reachable from initial_state without exceeding upper.
+    Returns the states as an array and a dictionary mapping state tuples to their indices.
+    """
+    index = {tuple(initial_state): 0}
+    states = [initial_state]
+    frontier = initial_state[np.newaxis, :]
+    while len(frontier):
+        a = _propensities(frontier, orders, rates)
+        new_states = []
+        for j in range(len(rates)):
+            successors = frontier[a[:, j] > 0] + changes[j]
+            successors = successors[np.all((successors >= 0) & (successors <= upper), axis=1)]
+            for successor in successors:
+                key = tuple(successor)
+                if key not in index:
+                    index[key] = len(states)
+                    states.append(successor)
+                    new_states.append(successor)
+        if max_states is not None and len(states) > max_states:
+            break
+        frontier = np.array(new_states, dtype=np.int64).reshape(-1, len(initial_state))
+    return np.array(states, dtype=np.int64), index
+
+
+def _count_states(initial_state, upper, changes, orders, rates, max_states):
+    states, _ = _enumerate_states(initial_state, upper, changes, orders, rates, max_states)
+    return len(states)
+
+
+def _build_generator(initial_state, upper, changes, orders, rates):
+    """
+    Builds the sparse generator matrix of the projected master equation (dp/dt = generator @ p). The states are
+    followed by one sink state per species collecting the probability leaving the bounds of that species.
+    """
+    states, index = _enumerate_states(initial_state, upper, changes, orders, rates)
+    n = len(states)
+    a = _propensities(states, orders, rates)
+    rows, cols, data = [], [], []
+    for j in range(len(rates)):
+        sources = np.flatnonzero(a[:, j] > 0)
+        successors = states[sources] + changes[j]
+        for source, successor in zip(sources, successors):
+            exceeding = np.flatnonzero(successor > upper)
+            target = n + exceeding[0] if len(exceeding) else index[tuple(successor)]
+            rows += [target, source]
+            cols += [source, source]
+            data += [a[source, j], -a[source, j]]
+    generator = csc_matrix((data, (rows, cols)), shape=(n + len(upper), n + len(upper)))
+    return states, generator
+
+
+def _propagate(generator, n_states, time_ini, times):
+    """
+    Propagates the initial distribution (all probability in the first state) to the given times
+    using the action of the sparse matrix exponential.
+    """
+    p = np.zeros(generator.shape[0])
+    p[0] = 1
+    probabilities = np.empty((len(times), generator.shape[0]))
+    time = time_ini
+    for k, t in enumerate(times):
+        if t > time:
+            p = expm_multiply(generator * (t - time), p)
+            p = np.maximum(p, 0)  # remove round-off negative probabilities
+            time = t
+        probabilities[k] = p
+    return probabilities
@@ -1,8 +1,18 @@
 """
 This file contains the utilities for plotting the simulation outputs and
 reading data from solver output files.
+
+For very large outputs, use read_outfile_chunks together with plot_outfile, resp. plot_outfile_with_EN (decimated
+plotting) and plot_ensemble_band (mean/percentile band over many trajectories) instead of read_outfile and
+simple_plot, resp. plot_with_EN.
 """
+import io
+from itertools import islice
+
 import matplotlib.pyplot as plt
+import numpy as np
+
+from ensemble import EnsembleStatistics, sample_on_grid
 
 
 def simple_plot(times, values, selected_species, xlog=False):
@@ -78,3 +88,360 @@ def read_outfile(filename):
     del values['time']
 
     return times, values
+
+
+def _parse_outfile_line(line):
+    """
+    Parses one line of an output file into a dictionary {name: value} (time included).
+    """
+    parsed = {}
+    for item in line.split(', '):
+        name, val = item.strip().split(': ')
+        parsed[name] = float(val)
+    return parsed
+
+
+def read_outfile_chunks(filename, chunk_size=100_000):
+    """
+    Reads an output file created by a method from solver.py in chunks, so that the whole file never has to be held
+    in memory as Python lists.
+
+    filename ... path to the output file
+    chunk_size ... number of lines parsed per chunk
+
+    It is a generator yielding tuples (times, values) for each chunk, where times is a numpy array and values is
+    a dictionary of numpy arrays, each of the same length as times.
+    """
+    with open(filename, 'r') as f:
+        first = f.readline()
+        while first and first.strip() == "":
+            first = f.readline()
+        if not first:
+            return
+        # all lines have the same columns, so the names are parsed only once and each chunk is converted by numpy
+        names = list(_parse_outfile_line(first))
+        lines = [first] + list(islice(f, chunk_size - 1))
+        while lines:
+            yield _lines_to_chunk(names, lines)
+            lines = list(islice(f, chunk_size))
+
+
+def _lines_to_chunk(names, lines):
+    """
+    Converts lines 'name: value, name: value, ...' with the columns names into the tuple (times, values) of numpy
+    arrays: without the commas, the lines are whitespace separated and every other column is a value.
+    """
+    text = ''.join(lines).replace(',', '')
+    data = np.loadtxt(io.StringIO(text), usecols=range(1, 2 * len(names), 2), ndmin=2)
+    values = {name: data[:, i] for i, name in enumerate(names) if name != 'time'}
+    return data[:, names.index('time')], values
+
+
+def outfile_time_range(filename):
+    """
+    Returns the tuple (first time, last time) of an output file without reading it whole
+    (only the first and the last line are parsed).
+    """
+    with open(filename, 'rb') as f:
+        first = f.readline().decode()
+        f.seek(0, 2)
+        position = f.tell()
+        block = b''
+        # read the file backwards until the last non-empty line is complete
+        while position > 0 and block.strip().count(b'\n') < 1:
+            step = min(4096, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step) + block
+        last = block.strip().split(b'\n')[-1].decode()
+    return _parse_outfile_line(first)['time'], _parse_outfile_line(last)['time']
+
+
+def _time_bins(time_ini, time_end, n_bins, xlog):
+    """
+    Returns bin edges covering [time_ini, time_end], logarithmically spaced if xlog (zero time_ini is replaced by
+    the smallest positive time, i.e., the first bin then also contains the time 0).
+    """
+    if xlog:
+        if time_ini <= 0:
+            time_ini = time_end * 1e-12
+        return np.logspace(np.log10(time_ini), np.log10(time_end), n_bins + 1)
+    return np.linspace(time_ini, time_end, n_bins + 1)
+
+
+class MinMaxDecimator:
+    """
+    Streaming min/max decimation of trajectories onto a fixed number of time bins.
+
+    For each bin and each species, the first, the minimal, the maximal and the last sample are kept (with their
+    times), so the plotted envelope of the decimated trajectory matches the full one. Chunks must be added in time
+    order; only O(n_bins) values per species are stored regardless of the trajectory length.
+
+    time_ini, time_end ... time range of the trajectory
+    n_bins ... number of bins (typically the width of the plot in pixels)
+    xlog ... if True, bins are logarithmically spaced (matching a logarithmic x-axis)
+    """
+
+    def __init__(self, time_ini, time_end, n_bins, xlog=False):
+        self.edges = _time_bins(time_ini, time_end, n_bins, xlog)
+        self.n_bins = n_bins
+        self.samples = {}  # species -> {bin: [(time, value) of first, min, max, last]}
+
+    def add(self, times, values):
+        """
+        Adds a chunk: times is an array of increasing timestamps, values a dictionary of arrays of the same length.
+        """
+        times = np.asarray(times, dtype=float)
+        if len(times) == 0:
+            return
+        bins = np.clip(np.searchsorted(self.edges, times, side='right') - 1, 0, self.n_bins - 1)
+        # times are sorted, hence each bin occupies a contiguous segment of the chunk
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        ends = np.r_[starts[1:], len(times)]
+        for species, ys in values.items():
+            ys = np.asarray(ys, dtype=float)
+            species_samples = self.samples.setdefault(species, {})
+            for start, end in zip(starts, ends):
+                segment = ys[start:end]
+                i_min = start + np.argmin(segment)
+                i_max = start + np.argmax(segment)
+                new = [(times[start], ys[start]), (times[i_min], ys[i_min]),
+                       (times[i_max], ys[i_max]), (times[end - 1], ys[end - 1])]
+                old = species_samples.get(bins[start])
+                if old is not None:  # the bin continues from the previous chunk
+                    new[0] = old[0]
+                    new[1] = min(old[1], new[1], key=lambda sample: sample[1])
+                    new[2] = max(old[2], new[2], key=lambda sample: sample[1])
+                species_samples[bins[start]] = new
+
+    def result(self):
+        """
+        Returns the decimated trajectory as a tuple (times, values), values being a dictionary of numpy arrays.
+        Unlike the solver output, each species has its own times, so times is a dictionary as well.
+        """
+        times = {}
+        values = {}
+        for species, species_samples in self.samples.items():
+            points = []
+            for b in sorted(species_samples):
+                # drop duplicates (e.g., the minimum being also the first sample), keep the time order
+                points += sorted(set(species_samples[b]))
+            points = np.array(points, dtype=float).reshape(-1, 2)
+            times[species] = points[:, 0]
+            values[species] = points[:, 1]
+        return times, values
+
+
+def decimate_minmax(times, ys, n_bins, xlog=False):
+    """
+    Min/max decimation of a single in-memory trajectory.
+
+    times ... list (or array) of increasing timestamps
+    ys ... list (or array) of values at times
+    n_bins ... number of time bins, at most 4 points are kept per bin
+    xlog ... if True, bins are logarithmically spaced
+
+    Returns the decimated tuple (times, ys) of numpy arrays.
+    """
+    times = np.asarray(times, dtype=float)
+    decimator = MinMaxDecimator(times[0], times[-1], n_bins, xlog)
+    decimator.add(times, {'y': ys})
+    dec_times, dec_values = decimator.result()
+    return dec_times['y'], dec_values['y']
+
+
+def decimate_lttb(times, ys, n_out, xlog=False, ylog=False):
+    """
+    Largest-Triangle-Three-Buckets decimation of a single in-memory trajectory.
+
+    times ... list (or array) of increasing timestamps
+    ys ... list (or array) of values at times
+    n_out ... number of points returned (at least 3)
+    xlog, ylog ... if True, triangle areas are measured in logarithmic time, resp. values, so the selection
+        matches what is seen on logarithmic axes
+
+    Returns the decimated tuple (times, ys) of numpy arrays.
+    """
+    times = np.asarray(times, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if n_out >= len(times) or n_out < 3:
+        return times, ys
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.log10(times) if xlog else times
+        y = np.log10(ys) if ylog else ys
+    # non-positive values cannot be shown on a logarithmic axis, they are treated as the smallest visible one
+    x = np.where(np.isfinite(x), x, np.min(x[np.isfinite(x)]))
+    y = np.where(np.isfinite(y), y, np.min(y[np.isfinite(y)]))
+
+    # the inner points are split into buckets equally wide in the (possibly logarithmic) time of the plot,
+    # the first and the last point are always kept
+    edges = np.searchsorted(x[1:-1], np.linspace(x[1], x[-2], n_out - 1)) + 1
+    edges[-1] = len(x) - 1
+    buckets = [(edges[i], edges[i + 1]) for i in range(n_out - 2) if edges[i + 1] > edges[i]]
+    selected = [0]
+    for k, (start, end) in enumerate(buckets):
+        # the third vertex of the triangle is the average of the next bucket (the last point for the last bucket)
+        if k + 1 < len(buckets):
+            next_start, next_end = buckets[k + 1]
+            avg_x, avg_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        a = selected[-1]
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        selected.append(start + int(np.argmax(areas)))
+    selected.append(len(x) - 1)
+    selected = np.unique(selected)
+    return times[selected], ys[selected]
+
+
+def _pixel_budget():
+    """
+    Number of horizontal pixels of the current figure: more points than that cannot be distinguished.
+    """
+    fig = plt.gcf()
+    return int(fig.get_figwidth() * fig.dpi)
+
+
+def _decimate_outfile(filename, columns, xlog, method, n_points, chunk_size, ylog_columns=()):
+    """
+    Reads the columns from an output file in chunks and decimates them (see plot_outfile).
+    Returns the decimated tuple (times, values), where times is a dictionary of per-column timestamps.
+    """
+    if method not in ('minmax', 'lttb'):
+        raise ValueError(f"Unknown decimation method '{method}', use 'minmax' or 'lttb'.")
+    if n_points is None:
+        n_points = _pixel_budget()
+    time_ini, time_end = outfile_time_range(filename)
+    # min/max keeps up to 4 points per bin, so the number of bins is n_points / 4 unless reduced further by LTTB
+    n_bins = n_points if method == 'lttb' else max(n_points // 4, 1)
+    decimator = MinMaxDecimator(time_ini, time_end, n_bins, xlog)
+    for times, values in read_outfile_chunks(filename, chunk_size):
+        missing = [column for column in columns if column not in values]
+        if missing:
+            raise ValueError(f"The output file '{filename}' does not contain {missing}.")
+        decimator.add(times, {column: values[column] for column in columns})
+    times, values = decimator.result()
+    if method == 'lttb':
+        for column in columns:
+            times[column], values[column] = decimate_lttb(times[column], values[column], n_points,
+                                                          xlog=xlog, ylog=column in ylog_columns)
+    return times, values
+
+
+def plot_outfile(filename, selected_species, xlog=False, method='minmax', n_points=None, chunk_size=100_000):
+    """
+    Plots the selected species from an output file of arbitrary size (see simple_plot) reading it in chunks and
+    decimating it to a pixel-bounded number of points.
+
+    filename ... output file created by a method from solver.py
+    selected_species ... names of the species to be plotted
+    xlog ... specifies if logarithmic x-axis (the decimation bins are then logarithmic as well)
+    method ... 'minmax' keeps the min/max envelope per pixel column, 'lttb' additionally reduces the envelope
+        to n_points points by Largest-Triangle-Three-Buckets
+    n_points ... budget of points per species, defaults to the width of the current figure in pixels
+    chunk_size ... number of lines of the output file parsed at once
+
+    Returns the decimated tuple (times, values), where times is a dictionary of per-species timestamps.
+    You should call plt.show() or plt.savefig(...) after running this method.
+    """
+    times, values = _decimate_outfile(filename, list(selected_species), xlog, method, n_points, chunk_size,
+                                      ylog_columns=selected_species)
+
+    plt.yscale("log")
+    if xlog: plt.xscale("log")
+    plt.xlabel("time [s]")
+    plt.ylabel("number of particles")
+    for species in selected_species:
+        plt.plot(times[species], values[species], label=species)
+    plt.legend()
+    return times, values
+
+
+def plot_outfile_with_EN(filename, selected_species, xlog=False, ylim=None, method='minmax', n_points=None,
+                         chunk_size=100_000):
+    """
+    Plots the selected species together with E/N on the second y-axis from an output file of arbitrary size
+    (see plot_with_EN), reading it in chunks and decimating it as plot_outfile does. The output file must contain
+    the column EN (i.e., EN must be among the parameters selected for the output).
+
+    filename, selected_species, xlog, method, n_points, chunk_size ... see plot_outfile
+    ylim ... if specified, sets ylim for the species y-axis
+
+    Returns the decimated tuple (times, values), values also contain EN.
+    You should call plt.show() or plt.savefig(...) after running this method.
+    """
+    times, values = _decimate_outfile(filename, list(selected_species) + ['EN'], xlog, method, n_points,
+                                      chunk_size, ylog_columns=selected_species)
+
+    fig, ax1 = plt.subplots()
+    if xlog: ax1.set_xscale("log")
+    ax2 = ax1.twinx()
+    ax1.set_yscale('log')
+    ax1.set_xlabel('time [s]')
+    ax1.set_ylabel("species concentration [m$^{-3}$]")
+    ax2.set_ylabel('EN', color='b')
+    for species in selected_species:
+        ax1.plot(times[species], values[species], label=species)
+    ax2.plot(times['EN'], values['EN'], 'b', label="EN")
+    ax1.legend()
+    ax2.legend()
+    if ylim: ax1.set_ylim(ylim)
+    return times, values
+
+
+def plot_ensemble_band(trajectories, selected_species, grid=None, n_points=None, percentiles=(10, 90), xlog=False):
+    """
+    Plots the mean and a percentile band of an ensemble of trajectories.
+
+    The trajectories are consumed one by one, each is immediately sampled on a common time grid and folded into
+    EnsembleStatistics (see ensemble.py), so the memory does not grow with the number of trajectories.
+
+    trajectories ... iterable of tuples (times, values) as returned by the solvers, or of output file names
+        (these are read in chunks); a generator running the simulations lazily works as well
+    selected_species ... keys from values to be plotted
+    grid ... common time grid, defaults to n_points times spanning the first trajectory (log-spaced if xlog)
+    n_points ... size of the default grid, defaults to the width of the current figure in pixels
+    percentiles ... lower and upper percentile of the band
+    xlog ... specifies if logarithmic x-axis
+
+    Returns tuple (grid, means, bands), where means is a dictionary of mean values on the grid and bands
+    a dictionary of (lower, upper) tuples.
+    You should call plt.show() or plt.savefig(...) after running this method.
+    """
+    if n_points is None:
+        n_points = _pixel_budget()
+    statistics = None
+    for trajectory in trajectories:
+        if isinstance(trajectory, str):
+            if grid is None:
+                grid = _time_bins(*outfile_time_range(trajectory), n_points - 1, xlog)
+            grid_values = {species: np.zeros(len(grid)) for species in selected_species}
+            for times, values in read_outfile_chunks(trajectory):
+                # only grid points covered by this chunk are filled in
+                covered = grid >= times[0]
+                for species in selected_species:
+                    grid_values[species][covered] = sample_on_grid(grid[covered], times, values[species])
+        else:
+            times, values = trajectory
+            times = np.asarray(times, dtype=float)
+            if grid is None:
+                grid = _time_bins(times[0], times[-1], n_points - 1, xlog)
+            grid_values = {species: sample_on_grid(grid, times, values[species]) for species in selected_species}
+        if statistics is None:
+            statistics = EnsembleStatistics(grid, selected_species)
+        statistics.add_sampled(grid_values)
+
+    means = {species: statistics.mean(species) for species in selected_species}
+    bands = {species: tuple(statistics.quantile(species, p / 100) for p in percentiles)
+             for species in selected_species}
+
+    plt.yscale("log")
+    if xlog: plt.xscale("log")
+    plt.xlabel("time [s]")
+    plt.ylabel("number of particles")
+    for species in selected_species:
+        line, = plt.plot(grid, means[species], label=species)
+        plt.fill_between(grid, bands[species][0], bands[species][1], color=line.get_color(), alpha=0.3)
+    plt.legend()
+    return grid, means, bands
@@ -1,8 +1,11 @@
 """
-This file contains the class Reaction and specifies its methods.
+This file contains the class Reaction and specifies its methods. It also contains helpers building
+the stoichiometry of a whole mechanism (a list of reactions) as numpy matrices.
 """
 from collections import Counter
 
+import numpy as np
+
 
 class Reaction:
     """
@@ -26,6 +29,14 @@ class Reaction:
         self.products = Counter(products)
         self.rate_fun = rate_fun
 
+    def __str__(self):
+        """
+        Returns the reaction in the input file syntax (without the rate), e.g., 'Ar + e => e + e + Ar^+'.
+        """
+        reactants = ' + '.join(specie for specie in self.reactants for _ in range(self.reactants[specie]))
+        products = ' + '.join(specie for specie in self.products for _ in range(self.products[specie]))
+        return f"{reactants} => {products}"
+
     def compute_a(self, parameters):
         """
         Compute transition rate a_mu of the reaction R_mu.
@@ -46,3 +57,66 @@ class Reaction:
         for product in self.products:
             parameters[product] += self.products[product] * bulk
         return parameters
+
+
+def stoichiometry_matrix(species, reactions):
+    """
+    Returns the net stoichiometry matrix of the mechanism as a numpy array of shape (len(species), len(reactions)):
+    element [i, j] is the change of the i-th species when the j-th reaction is executed once.
+
+    species ... ordered list of species names
+    reactions ... list of Reaction objects
+    """
+    matrix = np.zeros((len(species), len(reactions)))
+    for j, reaction in enumerate(reactions):
+        for i, specie in enumerate(species):
+            matrix[i, j] = reaction.products[specie] - reaction.reactants[specie]
+    return matrix
+
+
+def reactant_matrix(species, reactions):
+    """
+    Returns the matrix of reaction orders as a numpy array of shape (len(species), len(reactions)):
+    element [i, j] is the number of particles of the i-th species consumed by the j-th reaction.
+
+    species ... ordered list of species names
+    reactions ... list of Reaction objects
+    """
+    matrix = np.zeros((len(species), len(reactions)))
+    for j, reaction in enumerate(reactions):
+        for i, specie in enumerate(species):
+            matrix[i, j] = reaction.reactants[specie]
+    return matrix
+
+
+def mass_action_fluxes(orders, rates, concentrations):
+    """
+    Returns the deterministic (mass action) flux of each reaction as a numpy array of length len(rates).
+
+    orders ... reaction orders as returned by reactant_matrix
+    rates ... array of the reaction rates (values of rate_fun)
+    concentrations ... array of concentrations ordered as the rows of orders
+    """
+    return rates * np.prod(concentrations[:, np.newaxis] ** orders, axis=0)
+
+
+def mass_action_jacobian(changes, orders, rates, concentrations):
+    """
+    Returns the Jacobian of the mass action right-hand side changes @ mass_action_fluxes(...) with respect to
+    the concentrations (the rates are considered constant) as a numpy array of shape (species, species).
+
+    changes ... stoichiometry as returned by stoichiometry_matrix
+    orders ... reaction orders as returned by reactant_matrix
+    rates ... array of the reaction rates (values of rate_fun)
+    concentrations ... array of concentrations ordered as the rows of changes
+    """
+    # derivative of the flux of each reaction with respect to each concentration (reactions, species)
+    flux_derivatives = np.zeros((len(rates), len(concentrations)))
+    for j in range(len(rates)):
+        for i in np.flatnonzero(orders[:, j]):
+            derivative = rates[j] * orders[i, j] * concentrations[i] ** (orders[i, j] - 1)
+            for other in np.flatnonzero(orders[:, j]):
+                if other != i:
+                    derivative *= concentrations[other] ** orders[other, j]
+            flux_derivatives[j, i] = derivative
+    return changes @ flux_derivatives
@@ -0,0 +1,249 @@
+"""
+This file contains the automatic reduction of reaction mechanisms. Useful methods are:
+ * reaction_fluxes
+ * rank_reactions
+ * reduce_mechanism
+
+The reduction is driven by a pilot solution (a trajectory from a stochastic solver or the deterministic solution
+from solver.py). Reactions contributing negligibly to the production and consumption of every species are pruned
+and short-lived species are eliminated by the quasi-steady-state approximation (QSSA). The result is an ordinary
+list of Reaction objects, so it can be passed to any solver.
+"""
+import numpy as np
+
+from reactions import Reaction
+from solver import solve_numerical
+
+
+def reaction_fluxes(parameters, reactions, times, values, update=None):
+    """
+    Computes the (deterministic, mass action) flux of each reaction along a pilot solution.
+
+    parameters ... is a dictionary containing info parsed from the input file
+    reactions ... is a list of Reaction objects
+    times ... list of timestamps of the pilot solution
+    values ... dictionary of values at times as returned by the solvers (it can contain also other parameters
+        than species, e.g., 'EN' returned by solve_numerical_EN)
+    update [optional] ... method update(parameters, time) setting time dependent parameters used by the rates
+
+    Returns numpy array of shape (len(times), len(reactions)).
+    """
+    parameters = parameters.copy()  # do not modify the caller's parameters
+    fluxes = np.zeros((len(times), len(reactions)))
+    for k, time in enumerate(times):
+        for name in values:
+            parameters[name] = values[name][k]
+        if update: update(parameters, time=time)
+        for j, reaction in enumerate(reactions):
+            flux = reaction.rate_fun(parameters)
+            for reactant in reaction.reactants:
+                flux *= parameters[reactant] ** reaction.reactants[reactant]
+            fluxes[k, j] = max(flux, 0)
+    return fluxes
+
+
+def rank_reactions(all_species, reactions, fluxes):
+    """
+    Ranks reactions by their importance: the largest relative contribution of the reaction to the total rate
+    of change (production plus consumption) of any species at any time.
+
+    all_species ... is a set of specie names
+    reactions ... is a list of Reaction objects
+    fluxes ... reaction fluxes as returned by reaction_fluxes
+
+    Returns list of tuples (reaction index, importance) sorted from the most important reaction.
+    """
+    importance = np.zeros(len(reactions))
+    for specie in all_species:
+        changes = np.array([abs(reaction.products[specie] - reaction.reactants[specie]) for reaction in reactions])
+        if not changes.any():
+            continue
+        contributions = fluxes * changes  # (times, reactions)
+        totals = contributions.sum(axis=1)
+        valid = totals > 0
+        if valid.any():
+            relative = contributions[valid] / totals[valid, np.newaxis]
+            importance = np.maximum(importance, relative.max(axis=0))
+    order = np.argsort(-importance, kind='stable')
+    return [(int(j), float(importance[j])) for j in order]
+
+
+def fast_species(all_species, reactions, times, values, fluxes, timescale_ratio=1e-3):
+    """
+    Finds the species whose lifetime (concentration divided by the consumption rate) stays below
+    timescale_ratio * (times[-1] - times[0]) during the whole pilot solution.
+
+    Returns list of species names.
+    """
+    span = times[-1] - times[0]
+    fast = []
+    for specie in all_species:
+        orders = np.array([reaction.reactants[specie] for reaction in reactions])
+        consumption = fluxes @ orders
+        concentration = np.asarray(values[specie], dtype=float)
+        consumed = consumption > 0
+        if not consumed.any():
+            continue
+        lifetimes = concentration[consumed] / consumption[consumed]
+        if lifetimes.max() < timescale_ratio * span:
+            fast.append(specie)
+    return fast
+
+
+def reduce_mechanism(all_species, parameters, reactions, times, values, update=None, tolerance=1e-3, targets=None,
+                     fast=None, timescale_ratio=1e-3, check_error=True, method='Radau'):
+    """
+    Reduces the mechanism using a pilot solution (times, values).
+
+    First, reactions whose importance (see rank_reactions) is below tolerance are pruned. Then the fast species
+    (see fast_species) are eliminated by the quasi-steady-state approximation: each reaction producing the fast
+    species is replaced by one reaction per consumption channel of the species, with the rate multiplied by the
+    branching ratio of the channel (computed from the current parameters, so it follows e.g. E/N). Only species
+    consumed by reactions of the first order in them and produced one at a time can be eliminated this way;
+    the other ones are listed in the report as skipped. Initial concentrations of eliminated species are dropped.
+
+    all_species ... is a set of specie names
+    parameters ... is a dictionary containing info parsed from the input file
+    reactions ... is a list of Reaction objects
+    times, values ... pilot solution as returned by the solvers from solver.py
+    update [optional] ... method update(parameters, time) as passed to the solvers
+    tolerance ... reactions with importance below tolerance are pruned
+    targets [optional] ... species whose production and consumption decide the importance of reactions, defaults
+        to all species (a reaction that is the only source of a sink species such as e(W) is then never pruned)
+    fast [optional] ... species to be eliminated, if not specified they are found by fast_species
+    timescale_ratio ... passed to fast_species
+    check_error ... if True, both the full and the reduced mechanism are solved by solve_numerical and the
+        maximal relative difference of each species is reported
+    method ... integration method used for the error check
+
+    Returns tuple (reduced_species, reduced_reactions, report).
+    reduced_species ... set of species of the reduced mechanism
+    reduced_reactions ... list of Reaction objects
+    report ... dictionary with keys 'ranking' (from rank_reactions), 'pruned' (list of pruned reaction strings),
+        'eliminated' (list of species), 'skipped' (dictionary species -> reason) and 'error' (dictionary
+        species -> maximal relative error, only if check_error)
+    """
+    fluxes = reaction_fluxes(parameters, reactions, times, values, update)
+    ranking = rank_reactions(all_species if targets is None else targets, reactions, fluxes)
+    importance = dict(ranking)
+    kept = [reaction for j, reaction in enumerate(reactions) if importance[j] >= tolerance]
+    pruned = [str(reaction) for j, reaction in enumerate(reactions) if importance[j] < tolerance]
+
+    if fast is None:
+        kept_fluxes = fluxes[:, [j for j in range(len(reactions)) if importance[j] >= tolerance]]
+        fast = fast_species(all_species, kept, times, values, kept_fluxes, timescale_ratio)
+
+    reduced_reactions = kept
+    eliminated = []
+    skipped = {}
+    for specie in fast:
+        reason = _qssa_obstacle(specie, reduced_reactions)
+        if reason:
+            skipped[specie] = reason
+            continue
+        reduced_reactions = _eliminate(specie, reduced_reactions)
+        eliminated.append(specie)
+    reduced_species = set(all_species) - set(eliminated)
+
+    report = {'ranking': ranking, 'pruned': pruned, 'eliminated': eliminated, 'skipped': skipped}
+    if check_error:
+        report['error'] = reduction_error(all_species, parameters, reactions, reduced_species, reduced_reactions,
+                                          update=update, method=method)
+    return reduced_species, reduced_reactions, report
+
+
+def reduction_error(all_species, parameters, reactions, reduced_species, reduced_reactions, update=None,
+                    method='Radau'):
+    """
+    Solves both the full and the reduced mechanism by solve_numerical and compares them on the time grid of the
+    full solution.
+
+    Returns dictionary species -> maximal relative difference (relative to the maximum of the full solution).
+    """
+    times, values = solve_numerical(all_species, parameters.copy(), reactions, update=update, method=method)
+    reduced_times, reduced_values = solve_numerical(reduced_species, parameters.copy(), reduced_reactions,
+                                                    update=update, method=method)
+    error = {}
+    for specie in reduced_species:
+        reference = np.asarray(values[specie])
+        approximation = np.interp(times, reduced_times, reduced_values[specie])
+        scale = np.abs(reference).max()
+        error[specie] = float(np.abs(approximation - reference).max() / scale) if scale > 0 else 0.0
+    return error
+
+
+def _qssa_obstacle(specie, reactions):
+    """
+    Returns the reason why the species cannot be eliminated by QSSA from the reactions, or None if it can.
+    """
+    consumers = [reaction for reaction in reactions if reaction.reactants[specie]]
+    if not consumers:
+        return "it is not consumed by any reaction"
+    for reaction in reactions:
+        if reaction.reactants[specie] and reaction.products[specie]:
+            return f"it is both a reactant and a product of '{reaction}'"
+        if reaction.reactants[specie] > 1:
+            return f"it is consumed non-linearly by '{reaction}'"
+        if reaction.products[specie] > 1:
+            return f"more than one particle is produced by '{reaction}'"
+    return None
+
+
+def _eliminate(specie, reactions):
+    """
+    Eliminates the species from the reactions by QSSA (see reduce_mechanism).
+    """
+    consumers = [reaction for reaction in reactions if reaction.reactants[specie]]
+    producers = [reaction for reaction in reactions if reaction.products[specie]]
+    others = [reaction for reaction in reactions if not reaction.reactants[specie] and not reaction.products[specie]]
+
+    def pseudo_rate(consumer, prmtrs):
+        # pseudo-first-order rate of the consumption channel (per particle of the eliminated species)
+        rate = consumer.rate_fun(prmtrs)
+        for reactant in consumer.reactants:
+            if reactant != specie:
+                rate *= prmtrs[reactant] ** consumer.reactants[reactant]
+        return rate
+
+    lumped = []
+    for producer in producers:
+        for consumer in consumers:
+            partners = consumer.reactants.copy()
+            del partners[specie]
+            products = producer.products.copy()
+            del products[specie]
+            reaction = Reaction(list((producer.reactants + partners).elements()),
+                                list((products + consumer.products).elements()))
+            reaction.rate_fun = _lumped_rate(producer, consumer, consumers, partners, pseudo_rate)
+            lumped.append(reaction)
+    return others + lumped
+
+
+def _lumped_rate(producer, consumer, consumers, partners, pseudo_rate):
+    def rate_fun(prmtrs):
+        total = sum(pseudo_rate(channel, prmtrs) for channel in consumers)
+        if total <= 0:
+            return 0
+        # the partners of the consumption channel are reactants of the lumped reaction only to be consumed, so
+        # Reaction.compute_a multiplies the rate by the falling factorials of the merged counts of the producer
+        # reactants and the partners; these are replaced by the falling factorials of the producer reactants only,
+        # so that the transition rate is that of the producer times the branching ratio of the consumer
+        correction = 1
+        for partner in partners:
+            count = producer.reactants[partner]
+            merged = _falling_factorial(prmtrs[partner], count + partners[partner])
+            if merged == 0:
+                return 0  # compute_a gives zero for any rate
+            correction *= _falling_factorial(prmtrs[partner], count) / merged
+        return producer.rate_fun(prmtrs) * pseudo_rate(consumer, prmtrs) / total * correction
+    return rate_fun
+
+
+def _falling_factorial(x, n):
+    """
+    Returns x (x - 1) ... (x - n + 1), the factor of the species x in Reaction.compute_a for n such reactants.
+    """
+    result = 1
+    for i in range(n):
+        result *= x - i
+    return result
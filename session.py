@@ -0,0 +1,309 @@
+"""
+This file contains the incremental (resumable) solver sessions.
+
+The solvers from solver.py run from time_ini to time_end in one call. A session instead keeps the state of the
+simulation (parameters including the concentrations, time, number of iterations, superparticle weight) between
+calls, so a run can be advanced in steps, inspected (e.g., from a notebook), its parameters changed at a given
+time and its time_end extended, all without repeating the transient. Useful classes are:
+ * StochasticSession ... Monte Carlo simulation of solve_generic, resp. solve_withN (if main_specie is specified)
+ * NumericalSession ... deterministic simulation equivalent to solve_numerical
+
+StochasticSession.step is the only implementation of the Monte Carlo iteration: solve_generic and solve_withN run
+a StochasticSession from time_ini to time_end, and the weighted ensemble (splitting.py) advances it segment by
+segment with exact_end.
+
+Example:
+    session = StochasticSession(all_species, parameters, reactions)
+    session.advance(until=1e-6)
+    print(session.time, session.parameters['e'])
+    session.set_parameters({'EN': 50})  # inject a parameter at the current time
+    session.extend(2 * parameters['time_end'])
+    for time, state in session.snapshots(interval=1e-7):
+        print(time, state['e'])
+    times, values = session.result()
+"""
+import random as rnd
+from abc import ABC, abstractmethod
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+from reactions import stoichiometry_matrix, reactant_matrix, mass_action_fluxes
+
+
+class _Session(ABC):
+    """
+    Common part of the sessions: the recorded trajectory, snapshots, parameter injection and extension.
+
+    all_species ... is a set of specie names: e.g., {'Ar^+', 'e', 'Ar'}
+    parameters ... is a dictionary containing info parsed from the input file, such as time_ini, time_end,
+        calc_step, initial concentrations; the session works on its copy (available as session.parameters)
+    reactions ... is a list of Reaction objects
+    update [optional] ... method update(parameters, time) updating the parameters during the simulation
+    """
+
+    def __init__(self, all_species, parameters, reactions, update=None):
+        self.all_species = list(all_species)  # species need to be in an (any) order (deals with Set)
+        self.parameters = parameters.copy()
+        self.reactions = reactions
+        self.update = update
+        self.time = self.parameters['time_ini']
+        self.times = []
+        self.values = {specie: [] for specie in self.all_species}
+
+    @abstractmethod
+    def advance(self, until=None, events=None):
+        """
+        Advances the simulation until the time until (defaults to time_end) or by events iterations.
+        Returns the current time.
+        """
+
+    def finished(self):
+        """
+        Returns True if the simulation reached time_end.
+        """
+        return self.time >= self.parameters['time_end']
+
+    def extend(self, time_end):
+        """
+        Extends the simulation to the new time_end, the next advance continues from the current state.
+        """
+        if time_end < self.time:
+            raise ValueError(f"The new time_end {time_end} is before the current time {self.time}.")
+        self.parameters['time_end'] = time_end
+
+    def set_parameters(self, changes):
+        """
+        Changes parameters (e.g., EN or concentrations of species) at the current time of the simulation.
+
+        changes ... dictionary parameter name -> new value
+        """
+        self.parameters.update(changes)
+
+    def snapshot(self):
+        """
+        Returns the current state: dictionary of concentrations of all species (a copy).
+        """
+        return {specie: self.parameters[specie] for specie in self.all_species}
+
+    def snapshots(self, interval=None, events=None, until=None):
+        """
+        Generator advancing the simulation and yielding tuples (time, state) (see snapshot), starting with the
+        current state. The generator can be left and resumed at any point, parameters may be changed between the
+        snapshots.
+
+        interval [optional] ... time between two snapshots
+        events [optional] ... number of events (iterations of the stochastic solver) between two snapshots
+        until [optional] ... the generator stops at this time, defaults to time_end (read in every step, so
+            extending time_end extends the generator too)
+        """
+        if (interval is None) == (events is None):
+            raise ValueError("Specify exactly one of interval and events.")
+        yield self.time, self.snapshot()
+        while self.time < (until if until is not None else self.parameters['time_end']):
+            end = until if until is not None else self.parameters['time_end']
+            if interval is not None:
+                self.advance(until=min(self.time + interval, end))
+            else:
+                self.advance(until=end, events=events)
+            yield self.time, self.snapshot()
+
+    def result(self):
+        """
+        Returns tuple (times, values) recorded so far, in the same format as the solvers from solver.py return.
+        """
+        return np.array(self.times), {specie: np.array(self.values[specie]) for specie in self.all_species}
+
+    def _record(self):
+        self.times.append(self.time)
+        for specie in self.all_species:
+            self.values[specie].append(self.parameters[specie])
+
+
+class StochasticSession(_Session):
+    """
+    Resumable Monte Carlo simulation, solve_generic and solve_withN run it from time_ini to time_end.
+
+    In each iteration, a reaction is chosen (with equal reaction weights if ERW), executed bulk times and the time is
+    advanced, then update(parameters, time) is called. Every calc_step iterations, print_out and bulk_compute are
+    called and the state is recorded (or written into the outfile).
+
+    If main_specie is specified, the iteration is the one of solve_withN: if parameters contain N, the weight bulk
+    is computed (and rescaled if recompute_N) so that the main_specie is represented by about N superparticles,
+    and update is called with the time before the event, update(parameters, time - tau).
+
+    all_species, parameters, reactions, update ... see _Session (all_species are the recorded parameters, they may
+        include other parameters than species, e.g., EN)
+    bulk ... number of reactions processed in each iteration (ignored if N is used)
+    ERW ... if True, uses equal reaction weights for the simulation
+    main_specie [optional] ... a species name, N then represents superparticles of this species
+    recompute_N ... see solve_withN
+    bulk_compute [optional] ... called every calc_step iterations to update bulk:
+        bulk = bulk_compute(run, time, parameters, bulk)
+    print_out [optional] ... called every calc_step iterations to print/log progress: print_out(run, time, parameters)
+    outfile [optional] ... output filename, the recorded states are written into it instead of being kept in memory
+        (see solve_generic), the file is closed by close
+    event_log [optional] ... EventLog object (see event_log.py) recording every event, flushed after each advance
+    """
+
+    def __init__(self, all_species, parameters, reactions, update=None, bulk=1, ERW=False, main_specie=None,
+                 recompute_N=True, bulk_compute=None, print_out=None, outfile=None, event_log=None):
+        super().__init__(all_species, parameters, reactions, update)
+        self.ERW = ERW
+        self.main_specie = main_specie
+        self.recompute_N = recompute_N
+        self.bulk_compute = bulk_compute
+        self.print_out = print_out
+        self.event_log = event_log
+        self.out = open(outfile, "w") if outfile else None
+        self.run = 0
+        self._recorded_run = None  # the iteration recorded last (an iteration may be discarded, see step)
+        self.bulk = bulk
+        if main_specie is not None and 'N' in self.parameters:
+            self.bulk = self.parameters[main_specie] / self.parameters['N']
+
+    def step(self, until=None):
+        """
+        Executes one iteration (event) of the Monte Carlo simulation. Returns the index of the executed reaction.
+
+        until [optional] ... if the time of the event would exceed until, the event is not executed, the time is
+            set to until and None is returned; the waiting time is exponential (memoryless), so the state at until
+            is exact and the next iteration samples the waiting time anew
+        """
+        parameters = self.parameters
+
+        # after calc_step iterations
+        if self.run % parameters['calc_step'] == 0 and self._recorded_run != self.run:
+            if self.print_out: self.print_out(self.run, self.time, parameters)  # print out computation progress
+            if self.bulk_compute:  # update bulk value
+                self.bulk = self.bulk_compute(self.run, self.time, parameters, self.bulk)
+            self._record()
+            self._recorded_run = self.run
+
+        # sample a reaction
+        a = [reaction.compute_a(parameters) for reaction in self.reactions]
+        a0 = sum(a)
+        if abs(a0) < 1e-10:  # a0 is too small -> no possible reaction
+            raise ZeroDivisionError("There is no possible reaction given the particle concentrations.")
+        if self.ERW:
+            chosen_reaction_index = rnd.randrange(len(self.reactions))
+            # the weight of the chosen reaction is given by bulk and its transition rate
+            weight = self.bulk * len(self.reactions) * a[chosen_reaction_index] / a0
+        else:
+            a_cum = np.cumsum(a) / a0
+            chosen_reaction_index = min(int(np.searchsorted(a_cum, rnd.uniform(0, 1), side='right')),
+                                        len(self.reactions) - 1)
+            weight = self.bulk  # the weight of the chosen reaction is given by bulk
+
+        # sample a time delta
+        tau = 1 / a0 * np.log(1 / rnd.uniform(0, 1)) * weight
+        if until is not None and self.time + tau > until:
+            self.time = until
+            return None
+
+        # let the reaction react
+        self.reactions[chosen_reaction_index].react(parameters, weight)
+        self.time += tau
+        if self.event_log is not None: self.event_log.record(chosen_reaction_index, weight, tau)
+        if self.update:  # run the update function on the parameters to modify them
+            self.update(parameters, time=self.time if self.main_specie is None else self.time - tau)
+        self.run += 1
+
+        # check if particles need rescaling (N and bulk recomputation)
+        if self.main_specie is not None and self.recompute_N and 'N' in parameters:
+            actual_N = parameters[self.main_specie] / self.bulk
+            # if the current number of superparticles differs too much from the original N
+            if actual_N > parameters['N'] * 2 or actual_N < parameters['N'] * 0.5:
+                self.bulk = parameters[self.main_specie] / parameters['N']  # rescale to create N superparticles again
+        return chosen_reaction_index
+
+    def advance(self, until=None, events=None, exact_end=False):
+        """
+        Advances the simulation until the time until (defaults to time_end) or until events iterations are executed,
+        whichever comes first.
+
+        exact_end ... if False, the last event may exceed until (as in solve_generic); if True, the event crossing
+            until is not executed and the simulation stops exactly at until (see step), this is not supported with
+            the event_log (the skipped time would be missing from the log)
+
+        Returns the current time.
+        """
+        if exact_end and self.event_log is not None:
+            raise ValueError("The event log cannot record a simulation advanced with exact_end.")
+        until = min(until, self.parameters['time_end']) if until is not None else self.parameters['time_end']
+        executed = 0
+        try:
+            while self.time < until and (events is None or executed < events):
+                self.step(until if exact_end else None)
+                executed += 1
+        finally:
+            if self.event_log is not None: self.event_log.flush()
+        return self.time
+
+    def close(self):
+        """
+        Closes the outfile (if any).
+        """
+        if self.out:
+            self.out.close()
+            self.out = None
+
+    def _record(self):
+        if not self.out:
+            super()._record()
+            return
+        # write current time & selected parameters in the output file
+        self.out.write(f"time: {self.time}")
+        for param in self.all_species:
+            self.out.write(f", {param}: {self.parameters[param]}")
+        self.out.write("\n")
+        self.out.flush()
+
+
+class NumericalSession(_Session):
+    """
+    Resumable deterministic simulation (mass action kinetics integrated by solve_ivp as in solve_numerical). Each
+    advance integrates from the current state, so parameters changed by set_parameters apply from the current time
+    on. All the time steps of the integrator are recorded.
+
+    all_species, parameters, reactions, update ... see _Session
+    method ... passed to solve_ivp
+    """
+
+    def __init__(self, all_species, parameters, reactions, update=None, method='Radau'):
+        super().__init__(all_species, parameters, reactions, update)
+        self.method = method
+        self.changes = stoichiometry_matrix(self.all_species, reactions)
+        self.orders = reactant_matrix(self.all_species, reactions)
+        self._record()
+
+    def advance(self, until=None, events=None):
+        """
+        Integrates the system until the time until (defaults to time_end). Returns the current time.
+        """
+        if events is not None:
+            raise ValueError("The deterministic session can only be advanced in time, specify until.")
+        until = min(until, self.parameters['time_end']) if until is not None else self.parameters['time_end']
+        if until <= self.time:
+            return self.time
+        parameters = self.parameters
+
+        def fun(t, concentrations):
+            rates = np.array([reaction.rate_fun(parameters) for reaction in self.reactions], dtype=float)
+            differentials = self.changes @ mass_action_fluxes(self.orders, rates, concentrations)
+            if self.update:
+                self.update(parameters, time=t)
+            return differentials
+
+        initial_concentrations = np.array([parameters[specie] for specie in self.all_species], dtype=float)
+        sol = solve_ivp(fun, (self.time, until), initial_concentrations, method=self.method)
+        if not sol.success:
+            raise RuntimeError(f"The integration failed at time {sol.t[-1]}: {sol.message}")
+        for k in range(1, len(sol.t)):
+            self.times.append(sol.t[k])
+            for i, specie in enumerate(self.all_species):
+                self.values[specie].append(sol.y[i, k])
+        for i, specie in enumerate(self.all_species):
+            parameters[specie] = sol.y[i, -1]
+        self.time = until
+        return self.time
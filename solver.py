@@ -2,13 +2,16 @@
 This file contains methods for both stochastic and deterministic simulations.
 """
 import numpy as np
-import random as rnd
 
 from scipy.integrate import solve_ivp
+from scipy.sparse import block_diag, csc_matrix, identity, kron
+
+from reactions import stoichiometry_matrix, reactant_matrix, mass_action_fluxes, mass_action_jacobian
+from session import StochasticSession
 
 
 def solve_generic(selected_params, parameters, reactions, update=None, bulk=1, bulk_compute=None,
-                  print_out=None, outfile=None, ERW=False):
+                  print_out=None, outfile=None, ERW=False, event_log=None):
     """
     General method for Monte Carlo simulations. Best used for rather simple systems, otherwise implementing
     your own domain-specific function is superior in efficiency.
@@ -27,6 +30,8 @@ def solve_generic(selected_params, parameters, reactions, update=None, bulk=1, b
                     with signature: print_out(run, time, parameters)
     outfile ... [optional] output filename
     ERW ... if True, uses equal reaction weights for the simulation
+    event_log ... [optional] EventLog object (see event_log.py) recording every event (reaction index, weight
+        and time delta), it can be used with a large calc_step instead of storing the species
 
     The function returns tuple times, values if outfile is None, otherwise it returns None and saves the output
     continually in the output file. The contents of the output file can then be read and parsed into the times, values
@@ -35,72 +40,23 @@ def solve_generic(selected_params, parameters, reactions, update=None, bulk=1, b
     times ... list of timestamps (time for each calc_step-th iteration of the algorithm)
     values ... dictionary of values of selected_params from parameters for each calc_step-th iteration of the algorithm
     E.g.; times = [0, 0.5, 1], values = {'e': [100, 98, 96], 'Ar': [1000, 1000, 1000]}
-    """
 
-    if outfile:
-        out = open(outfile, "w")
-    else:
-        times = []  # this will store the timestamps
-        values = {param: [] for param in selected_params}  # stores the parameters values for each timestamp
-
-    eps = 1e-10  # for checking a0 is not too small -> no possible reaction
-    time = parameters["time_ini"]
-    run = 0
-    while time < parameters["time_end"]:
-
-        # after calc_step iterations
-        if run % parameters['calc_step'] == 0:
-            if print_out: print_out(run, time, parameters)  # print out computation progress
-            if bulk_compute:  # update bulk value
-                bulk = bulk_compute(run, time, parameters, bulk)
-            if not outfile:  # save current time & parameters including concentrations
-                for param in selected_params:
-                    values[param].append(parameters[param])
-                times.append(time)
-            else:  # write current time & selected parameters in the output file
-                out.write(f"time: {time}")
-                for param in selected_params:
-                    out.write(f", {param}: {parameters[param]}")
-                out.write("\n")
-                out.flush()
-
-        # sample a reaction and let it react
-        a = [reaction.compute_a(parameters) for reaction in reactions]
-        a0 = sum(a)
-        if abs(a0) < eps:
-            raise ZeroDivisionError("There is no possible reaction given the particle concentrations.")
-        a_cum = [aa / a0 for aa in np.cumsum(a)]
-
-        # choose the reaction
-        if ERW:
-            chosen_reaction_index = rnd.randrange(len(reactions))
-            # the weight of the chosen reaction is given by bulk and its transition rate
-            weight = bulk * len(reactions) * a[chosen_reaction_index] / a0
-        else:
-            r2 = rnd.uniform(0, 1)
-            for partial_sum in a_cum:
-                if r2 < partial_sum:
-                    chosen_reaction_index = a_cum.index(partial_sum)
-                    break
-            weight = bulk  # the weight of the chosen reaction is given by bulk
-        parameters = reactions[chosen_reaction_index].react(parameters, weight)
-
-        # sample a time delta
-        r1 = rnd.uniform(0, 1)
-        tau = 1 / a0 * np.log(1 / r1) * weight
-        time += tau
-
-        if update: update(parameters, time=time)  # run the update function on the parameters to modify them
-        run += 1
-
-    if outfile:  # close the file and return None
-        out.close()
-    else:  # return the computed concentrations
-        return times, values
+    The iteration is implemented by StochasticSession (see session.py), which can also run the simulation
+    incrementally. The parameters are modified in place (they contain the final state after the simulation).
+    """
+    session = StochasticSession(selected_params, parameters, reactions, update=update, bulk=bulk, ERW=ERW,
+                                bulk_compute=bulk_compute, print_out=print_out, outfile=outfile, event_log=event_log)
+    try:
+        session.advance()
+    finally:
+        session.close()
+        parameters.update(session.parameters)
+    if not outfile:  # return the computed concentrations
+        return session.times, session.values
 
 
 def solve_withN(all_species, parameters, reactions, update=None, bulk=1, recompute_N=True, main_specie='e',
-                verbose=False):
+                verbose=False, event_log=None):
     """
     A more specific derivative of the method 'solve_generic' working explicitly with the number of superparticles N.
     The number of superparticles is considered for the main_specie.
@@ -118,68 +74,32 @@ def solve_withN(all_species, parameters, reactions, update=None, bulk=1, recompu
         than 0.5N, the superparticle weight is recomputed so that the actual number of superparticles is N again
     main_specie ... a species name from all_species, N then represents superparticles of this species
     verbose ... if True, prints progress periodically after calc_step iterations
+    event_log ... [optional] EventLog object (see event_log.py) recording every event (reaction index, weight
+        and time delta)
 
     Returns tuple (times, values).
     times ... list of timestamps (time for each calc_step-th iteration of the algorithm)
     values ... dictionary of values of selected_params from parameters for each calc_step-th iteration of the algorithm
     E.g.; times = [0, 0.5, 1], values = {'e': [100, 98, 96], 'Ar': [1000, 1000, 1000]}
-    """
 
-    # compute bulk if N specified in parameters
-    if 'N' in parameters:  # if N not specified, do nothing
-        bulk = parameters[main_specie] / parameters['N']
-
-    times = []  # this will store the timestamps
-    values = {species: [] for species in all_species}  # stores the concentrations per specie for each timestamp
-
-    eps = 1e-10  # for checking a0 is not too small -> no possible reaction
-    time = parameters["time_ini"]
-    run = 0
-    while time < parameters["time_end"]:
-
-        # only save next timestamp (and concentrations) after calc_step steps
-        if run % parameters['calc_step'] == 0:
-            if verbose:
-                print(f"run: {run}, time: {time}, EN: {parameters['EN']}, Ar: {parameters['Ar']}, e: {parameters['e']}")
-            for species in all_species:
-                values[species].append(parameters[species])
-            times.append(time)
-
-        # sample a reaction and let it react
-        a = [reaction.compute_a(parameters) for reaction in reactions]
-        a0 = sum(a)
-        if abs(a0) < eps:
-            raise ZeroDivisionError("There is no possible reaction given the particle concentrations.")
-        a_cum = [aa / a0 for aa in np.cumsum(a)]
-
-        # choose next reaction
-        r2 = rnd.uniform(0, 1)
-        for partial_sum in a_cum:
-            if r2 < partial_sum:
-                reaction_index = a_cum.index(partial_sum)
-                break
-        parameters = reactions[reaction_index].react(parameters, bulk)
-
-        # sample a time delta
-        r1 = rnd.uniform(0, 1)
-        tau = 1 / a0 * np.log(1 / r1) * bulk
-        time += tau
-
-        # run the update function on the parameters to modify them
-        if update: update(parameters, time=time - tau)
-        run += 1
-
-        # check if particles need rescaling (N and bulk recomputation)
-        if recompute_N:
-            actual_N = parameters[main_specie] / bulk
-            # if the current number of superparticles differs too much from the original N
-            if actual_N > parameters['N'] * 2 or actual_N < parameters['N'] * 0.5:
-                bulk = parameters[main_specie] / parameters['N']  # rescale to create N superparticles again
+    The iteration is implemented by StochasticSession (see session.py) with main_specie specified, which can also
+    run the simulation incrementally. The parameters are modified in place (they contain the final state after
+    the simulation).
+    """
+    def print_progress(run, time, prmtrs):
+        print(f"run: {run}, time: {time}, EN: {prmtrs['EN']}, Ar: {prmtrs['Ar']}, e: {prmtrs['e']}")
 
-    return times, values
+    session = StochasticSession(all_species, parameters, reactions, update=update, bulk=bulk, main_specie=main_specie,
+                                recompute_N=recompute_N, print_out=print_progress if verbose else None,
+                                event_log=event_log)
+    try:
+        session.advance()
+    finally:
+        parameters.update(session.parameters)
+    return session.times, session.values
 
 
-def solve_numerical(all_species, parameters, reactions, update=None, method=None):
+def solve_numerical(all_species, parameters, reactions, update=None, method=None, sensitivities=False):
     """
     Generic numerical deterministic solver method
 
@@ -196,7 +116,13 @@ def solve_numerical(all_species, parameters, reactions, update=None, method=None
         the parameters can be used as an input for reaction rates
     method [optional] ... if specified, it is passed to solve_ivp, for possible options see docs:
         https://docs.scipy.org/doc/scipy/reference/generated/scipy.integrate.solve_ivp.html
+    sensitivities [optional] ... if True, forward sensitivities are integrated together with the concentrations
+        (see solve_numerical_sensitivity) and the tuple (times, values, sensitivities) is returned
     """
+    if sensitivities:
+        return solve_numerical_sensitivity(all_species, parameters, reactions, update=update,
+                                           method=method if method else 'BDF')
+
     all_species = list(all_species)  # species need to be in an (any) order (deals with Set)
 
     initial_concentrations = [parameters[specie] for specie in all_species]
@@ -236,6 +162,80 @@ def solve_numerical(all_species, parameters, reactions, update=None, method=None
     return times, values
 
 
+def solve_numerical_sensitivity(all_species, parameters, reactions, update=None, method='BDF'):
+    """
+    Deterministic solver integrating the forward sensitivity equations together with the concentrations.
+
+    The sensitivities are computed with respect to a multiplier of each reaction rate (i.e., the derivative with
+    respect to the logarithm of the rate constant) and with respect to each initial concentration, all in one
+    augmented solve instead of one perturbed solve per parameter. The sensitivity equations share the Jacobian
+    of the mechanism, so the Jacobian of the augmented system is passed to the implicit methods as a sparse block
+    diagonal matrix made of copies of it (the second derivative coupling is neglected, as in the simultaneous
+    corrector method, which only slows down the Newton convergence slightly).
+
+    all_species ... is a set of specie names: e.g., {'Ar^+', 'e', 'Ar'}
+    parameters ... is a dictionary containing info parsed from the input file, such as time_ini, calc_step,
+        initial concentrations
+    reactions ... is a list of Reaction objects (i.e. reaction[0] corresponds to the first reaction, stored
+        as instance of the class Reaction specified in reactions.py)
+    update [optional] ... method update(parameters, time) updates any parameters based on the simulation time,
+        the parameters can be used as an input for reaction rates
+    method ... passed to solve_ivp, a stiff method ('BDF' or 'Radau') makes use of the Jacobian
+
+    Returns tuple (times, values, sensitivities).
+    times, values ... the same as returned by solve_numerical
+    sensitivities ... dictionary of dictionaries: sensitivities[specie][j] is the array of derivatives of
+        the specie concentration with respect to the logarithm of the rate of the j-th reaction (j is an index into
+        reactions), sensitivities[specie][other_specie] is the array of derivatives with respect to the initial
+        concentration of other_specie
+    """
+    all_species = list(all_species)  # species need to be in an (any) order (deals with Set)
+    n = len(all_species)
+    r = len(reactions)
+    changes = stoichiometry_matrix(all_species, reactions)  # (species, reactions)
+    orders = reactant_matrix(all_species, reactions)
+
+    time_ini = parameters['time_ini']
+    time_end = parameters['time_end']
+
+    def rates():
+        return np.array([reaction.rate_fun(parameters) for reaction in reactions], dtype=float)
+
+    def fun(t, y):
+        concentrations = y[:n]
+        s = y[n:].reshape(n, r + n)  # columns: rate multipliers, then initial concentrations
+        rate_values = rates()
+        fluxes = mass_action_fluxes(orders, rate_values, concentrations)
+        ds = mass_action_jacobian(changes, orders, rate_values, concentrations) @ s
+        ds[:, :r] += changes * fluxes  # explicit dependence of the right-hand side on the rate multipliers
+        if update:
+            update(parameters, time=t)
+        return np.concatenate([changes @ fluxes, ds.ravel()])
+
+    def jac(t, y):
+        block = csc_matrix(mass_action_jacobian(changes, orders, rates(), y[:n]))
+        # the sensitivities are stored row by row (per specie), so their Jacobian is J kron I
+        return block_diag([block, kron(block, identity(r + n))], format='csc')
+
+    initial_concentrations = [parameters[specie] for specie in all_species]
+    initial_sensitivities = np.hstack([np.zeros((n, r)), np.eye(n)])
+    y0 = np.concatenate([initial_concentrations, initial_sensitivities.ravel()])
+
+    if method in ('BDF', 'Radau'):
+        sol = solve_ivp(fun, (time_ini, time_end), y0, method=method, jac=jac)
+    else:
+        sol = solve_ivp(fun, (time_ini, time_end), y0, method=method)
+    times = sol.t
+    values = {all_species[i]: sol.y[i] for i in range(n)}
+    s = sol.y[n:].reshape(n, r + n, len(times))
+    sensitivities = {}
+    for i, specie in enumerate(all_species):
+        sensitivities[specie] = {j: s[i, j] for j in range(r)}
+        sensitivities[specie].update({other: s[i, r + k] for k, other in enumerate(all_species)})
+
+    return times, values, sensitivities
+
+
 def solve_numerical_EN(all_species, parameters, reactions, update, precision=1e4, verbose=False):
     """
     Numerical deterministic solver method made specifically for systems depending solely on E/N ratio
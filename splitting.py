@@ -0,0 +1,151 @@
+"""
+This file contains the weighted ensemble driver for rare-event and first-passage statistics.
+
+Plain Monte Carlo needs about 1/p trajectories to see an event of probability p. The weighted ensemble method
+instead runs a fixed number of weighted trajectories (walkers) per bin of a progress coordinate: walkers that
+advance towards the event are split (cloned with their weight halved) and walkers crowding the visited bins are
+merged, so the total weight is preserved and every bin on the way to the event stays populated. The cost then
+grows with the number of bins, i.e., roughly with log(1/p). Useful methods are:
+ * weighted_ensemble
+ * resample
+"""
+import random as rnd
+
+import numpy as np
+
+from session import StochasticSession
+
+
+class _TargetReached(Exception):
+    """Exception raised from the update method of a walker to stop the simulation at the first passage."""
+
+    def __init__(self, time):
+        self.time = time
+
+
+def weighted_ensemble(parameters, reactions, progress, bins, target, tau, walkers_per_bin=10, update=None,
+                      bulk=1, ERW=False, verbose=False):
+    """
+    Estimates the probability that target(parameters) becomes true before time_end and the first-passage time
+    distribution by the weighted ensemble method.
+
+    The time interval time_ini - time_end is split into segments of length tau. In each segment, every walker is
+    propagated by StochasticSession as in solve_generic (see _propagate). Walkers reaching the target are
+    removed and their weights and first-passage times recorded. The others are assigned to bins of the progress
+    coordinate and resampled (see resample).
+
+    parameters ... is a dictionary containing info parsed from the input file, such as time_ini, time_end,
+        initial concentrations (it is not modified)
+    reactions ... is a list of Reaction objects
+    progress ... function progress(parameters) returning a float, it should increase towards the target,
+        e.g., lambda prmtrs: -prmtrs['e'] for the first passage of 'e' below a threshold
+    bins ... increasing edges of the progress coordinate bins (values outside fall into the first or the last bin)
+    target ... function target(parameters) returning True when the rare event happened,
+        e.g., lambda prmtrs: prmtrs['e'] < 100
+    tau ... length of the segment between two resamplings
+    walkers_per_bin ... number of walkers kept in every occupied bin
+    update [optional] ... method update(parameters, time) called after each reaction
+    bulk, ERW ... see solve_generic
+    verbose ... if True, prints the number of walkers and the target probability after each segment
+
+    Returns dictionary with keys:
+        'probability' ... estimated probability of reaching the target before time_end
+        'first_passage_times', 'first_passage_weights' ... arrays of the first-passage times and weights of
+            the walkers reaching the target, the distribution of the first-passage time can be obtained, e.g.,
+            by np.histogram(first_passage_times, weights=first_passage_weights)
+        'segments' ... number of segments
+        'walkers' ... list of the number of walkers after each segment
+    """
+    walker = parameters.copy()
+    walker['calc_step'] = 2 ** 62  # the walkers do not need to record their trajectories
+    walkers = [(walker, 1.0)]
+    time = parameters['time_ini']
+    passage_times = []
+    passage_weights = []
+    walker_counts = []
+    if target(walker):
+        passage_times.append(time)
+        passage_weights.append(1.0)
+        walkers = []
+
+    segments = 0
+    while walkers and time < parameters['time_end']:
+        segment_end = min(time + tau, parameters['time_end'])
+        survivors = []
+        for prmtrs, weight in walkers:
+            passage_time = _propagate(prmtrs, reactions, time, segment_end, target, update, bulk, ERW)
+            if passage_time is None:
+                survivors.append((prmtrs, weight))
+            else:
+                passage_times.append(passage_time)
+                passage_weights.append(weight)
+        walkers = resample(survivors, [progress(prmtrs) for prmtrs, weight in survivors], bins, walkers_per_bin)
+        time = segment_end
+        segments += 1
+        walker_counts.append(len(walkers))
+        if verbose:
+            print(f"segment: {segments}, time: {time}, walkers: {len(walkers)}, probability: {sum(passage_weights)}")
+
+    return {'probability': sum(passage_weights), 'first_passage_times': np.array(passage_times),
+            'first_passage_weights': np.array(passage_weights), 'segments': segments, 'walkers': walker_counts}
+
+
+def resample(walkers, coordinates, bins, walkers_per_bin):
+    """
+    Resamples weighted walkers so that every occupied bin contains walkers_per_bin walkers, preserving the total
+    weight in each bin (Huber & Kim): the heaviest walker is split into two halves while there are too few walkers,
+    the two lightest walkers are merged while there are too many (the merged walker keeps the state of one of them
+    chosen with probability proportional to their weights).
+
+    walkers ... list of tuples (parameters, weight)
+    coordinates ... progress coordinate of each walker
+    bins ... increasing edges of the bins
+    walkers_per_bin ... number of walkers kept in every occupied bin
+
+    Returns the new list of tuples (parameters, weight).
+    """
+    bin_indices = np.searchsorted(bins, coordinates, side='right')
+    resampled = []
+    for b in np.unique(bin_indices):
+        members = [walkers[i] for i in np.flatnonzero(bin_indices == b)]
+        while len(members) > walkers_per_bin:
+            members.sort(key=lambda walker: walker[1])
+            (first, first_weight), (second, second_weight) = members[0], members[1]
+            total = first_weight + second_weight
+            kept = first if rnd.uniform(0, total) < first_weight else second
+            members = [(kept, total)] + members[2:]
+        while len(members) < walkers_per_bin:
+            members.sort(key=lambda walker: walker[1])
+            heaviest, weight = members.pop()
+            members += [(heaviest, weight / 2), (heaviest.copy(), weight / 2)]
+        resampled += members
+    return resampled
+
+
+def _propagate(prmtrs, reactions, time, segment_end, target, update, bulk, ERW):
+    """
+    Propagates a walker (its parameters are modified in place) from time to segment_end.
+
+    The walker is advanced by StochasticSession with exact_end: the reaction whose time would exceed segment_end
+    is not executed, the waiting time is exponential (memoryless), so the state at segment_end is exact and the next
+    segment samples the waiting time anew (executing the reaction would add a spurious reaction per segment).
+
+    Returns the first-passage time if the target was reached, None otherwise.
+    """
+    def stop_at_target(parameters, time):
+        if update: update(parameters, time=time)
+        if target(parameters):
+            raise _TargetReached(time)
+
+    prmtrs['time_ini'] = time
+    prmtrs['time_end'] = segment_end
+    session = StochasticSession([], prmtrs, reactions, update=stop_at_target, bulk=bulk, ERW=ERW)
+    try:
+        session.advance(exact_end=True)
+    except _TargetReached as reached:
+        return reached.time
+    except ZeroDivisionError:  # no reaction is possible, the walker stays in its state
+        pass
+    finally:
+        prmtrs.update(session.parameters)
+    return None
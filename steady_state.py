@@ -0,0 +1,276 @@
+"""
+This file contains the direct steady-state solver for deterministic (mass action) mechanisms.
+
+Instead of integrating the whole transient by solve_numerical, the steady state is found by solving
+RHS = 0 with the Newton method. The conservation laws of the mechanism (left null space of the stoichiometry
+matrix) make the Jacobian singular, so the equations along them are replaced by the conservation of the initial
+totals. When the Newton method fails, pseudo-transient continuation is used. Useful methods are:
+ * conservation_laws
+ * solve_steady_state
+ * steady_state_continuation
+"""
+import numpy as np
+
+from reactions import stoichiometry_matrix, reactant_matrix, mass_action_fluxes, mass_action_jacobian
+
+
+class SteadyStateError(Exception):
+    """Exception raised when neither the Newton method nor the pseudo-transient continuation converge.
+
+    Attributes:
+        message -- explanation of the error
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+def conservation_laws(species, reactions):
+    """
+    Finds the conservation laws of the mechanism: vectors l such that l @ concentrations is constant in time.
+
+    species ... ordered list of species names
+    reactions ... list of Reaction objects
+
+    Returns tuple (range_basis, laws) of numpy arrays with orthonormal columns: range_basis spans the possible
+    directions of change of the concentrations (the range of the stoichiometry matrix), laws (of shape
+    (len(species), number of conservation laws)) spans its orthogonal complement.
+    """
+    changes = stoichiometry_matrix(species, reactions)
+    u, singular_values, _ = np.linalg.svd(changes)
+    tolerance = max(changes.shape) * np.finfo(float).eps * (singular_values.max() if len(singular_values) else 0)
+    rank = int(np.sum(singular_values > tolerance))
+    return u[:, :rank], u[:, rank:]
+
+
+def solve_steady_state(all_species, parameters, reactions, fixed_species=(), guess=None, rtol=1e-8, atol=None,
+                       max_iter=50, max_steps=10_000, prefer_stable=True, verbose=False):
+    """
+    Solves for the steady state of the mechanism with the totals of the conservation laws given by the initial
+    concentrations in parameters.
+
+    all_species ... is a set of specie names: e.g., {'Ar^+', 'e', 'Ar'}
+    parameters ... is a dictionary containing info parsed from the input file, such as initial concentrations
+        and parameters used by the reaction rates (e.g., EN); it is not modified
+    reactions ... is a list of Reaction objects
+    fixed_species ... species kept constant at their value in parameters: reservoirs and sinks such as e(W)
+        (a sink only growing in time has no steady state, so it must be fixed)
+    guess [optional] ... dictionary of initial guesses of concentrations, defaults to parameters; the totals
+        of the conservation laws are always taken from parameters
+    rtol, atol ... the iteration stops when each Newton step is below rtol * |concentration| + atol and the
+        right-hand side of each species is below rtol times its production plus consumption flux (plus atol times
+        the fastest relaxation rate, for species vanishing in the steady state); atol is a number or a dictionary
+        species -> absolute tolerance, it defaults to 1e-6 * rtol times the initial concentration of each species
+        (species starting at zero use the smallest non-zero initial concentration)
+    max_iter ... maximal number of Newton iterations before switching to pseudo-transient continuation
+    max_steps ... maximal number of pseudo-transient continuation steps
+    prefer_stable ... if True and the Newton method converges to an unstable steady state (e.g., the trivial state
+        without electrons), the pseudo-transient continuation, which follows the dynamics of the system, is tried
+        and its result is used if it is stable
+    verbose ... if True, prints out the progress of the iterations
+
+    Returns tuple (values, info).
+    values ... dictionary of steady-state concentrations of all species (including the fixed ones)
+    info ... dictionary with keys 'method' ('newton' or 'pseudo-transient'), 'iterations', 'residual'
+        (maximal absolute value of the right-hand side), 'stable' (linear stability of the steady state) and
+        'conservation_laws' (list of dictionaries species -> coefficient, one for each law)
+
+    Raises SteadyStateError if no point satisfying the convergence criteria is found.
+    """
+    species = [specie for specie in all_species if specie not in fixed_species]
+    parameters = parameters.copy()
+    changes = stoichiometry_matrix(species, reactions)
+    orders = reactant_matrix(species, reactions)
+    range_basis, laws = conservation_laws(species, reactions)
+    initial_concentrations = np.array([parameters[specie] for specie in species], dtype=float)
+    laws, pivots = _pivot_laws(laws, initial_concentrations)
+    totals = laws.T @ initial_concentrations
+
+    if guess is None:
+        guess = parameters
+    c = np.array([guess[specie] for specie in species], dtype=float)
+    if atol is None:
+        nonzero = np.abs(initial_concentrations[initial_concentrations != 0])
+        floor = nonzero.min() if len(nonzero) else 1
+        atol = rtol * 1e-6 * np.where(initial_concentrations != 0, np.abs(initial_concentrations), floor)
+    elif isinstance(atol, dict):
+        atol = np.array([atol[specie] for specie in species], dtype=float)
+
+    def rates_at(concentrations):
+        for i, specie in enumerate(species):
+            parameters[specie] = concentrations[i]
+        rates = np.array([reaction.rate_fun(parameters) for reaction in reactions], dtype=float)
+        for j, reaction in enumerate(reactions):  # the fixed species contribute to the rates as constants
+            for reactant in reaction.reactants:
+                if reactant in fixed_species:
+                    rates[j] *= parameters[reactant] ** reaction.reactants[reactant]
+        return rates
+
+    def rhs(concentrations):
+        return changes @ mass_action_fluxes(orders, rates_at(concentrations), concentrations)
+
+    def jacobian(concentrations):
+        return mass_action_jacobian(changes, orders, rates_at(concentrations), concentrations)
+
+    rate_scale = max(np.abs(np.diag(jacobian(c))).max(), 1e-300)  # the fastest relaxation rate
+
+    def converged(step, concentrations):
+        if not np.all(np.abs(step) <= rtol * np.abs(concentrations) + atol):
+            return False
+        # a small step is not enough (e.g., a damped step towards zero), the right-hand side must vanish too
+        fluxes = mass_action_fluxes(orders, rates_at(concentrations), concentrations)
+        return bool(np.all(np.abs(changes @ fluxes) <= rtol * (np.abs(changes) @ fluxes) + atol * rate_scale))
+
+    def stable(concentrations):
+        # no eigenvalue of the Jacobian restricted to the directions of change has a positive real part (up to
+        # round-off, marginal directions such as Ar at the state without electrons do not grow)
+        restricted = range_basis.T @ jacobian(concentrations) @ range_basis
+        eigenvalues = np.linalg.eigvals(restricted).real
+        return bool(np.all(eigenvalues < 1e-10 * rate_scale)) if len(restricted) else True
+
+    initial = c
+    c, iterations = _newton(initial, rhs, jacobian, laws, pivots, totals, converged, max_iter, verbose)
+    method = 'newton'
+    if c is None or (prefer_stable and not stable(c)):
+        if verbose:
+            print("Newton method failed or found an unstable steady state, switching to pseudo-transient continuation")
+        try:
+            transient = _pseudo_transient(initial, rhs, jacobian, converged, max_steps, atol, verbose)
+            # polish the solution and enforce the conservation laws exactly
+            polished, polish_iterations = _newton(transient, rhs, jacobian, laws, pivots, totals, converged,
+                                                  max_iter, verbose)
+        except SteadyStateError:
+            polished = None
+        if polished is not None and (c is None or stable(polished)):
+            c = polished
+            method = 'pseudo-transient'
+            iterations += polish_iterations
+        elif c is None:
+            raise SteadyStateError("The steady state iteration did not converge.")
+
+    values = {specie: c[i] for i, specie in enumerate(species)}
+    for specie in fixed_species:
+        if specie in all_species:
+            values[specie] = parameters[specie]
+    info = {'method': method, 'iterations': iterations, 'residual': float(np.abs(rhs(c)).max()), 'stable': stable(c),
+            'conservation_laws': [dict(zip(species, law)) for law in laws.T]}
+    return values, info
+
+
+def steady_state_continuation(all_species, parameters, reactions, parameter, parameter_values, fixed_species=(),
+                              verbose=False, **kwargs):
+    """
+    Traces the steady state along a parameter (e.g., 'EN'): the steady state for each value is solved by
+    solve_steady_state starting from a secant extrapolation of the previous two solutions, which is usually close
+    enough for a few Newton iterations.
+
+    all_species, parameters, reactions, fixed_species ... see solve_steady_state
+    parameter ... name of the parameter in parameters
+    parameter_values ... list of the parameter values (ordered along the traced curve)
+    verbose ... if True, prints out each solution
+    kwargs ... other keyword arguments passed to solve_steady_state
+
+    Returns tuple (parameter_values, values) where values is a dictionary of arrays of steady-state concentrations,
+    in the same format as the solvers from solver.py return (times, values).
+    """
+    parameters = parameters.copy()
+    solutions = []
+    for k, value in enumerate(parameter_values):
+        parameters[parameter] = value
+        guess = None
+        if k >= 2 and parameter_values[k - 1] != parameter_values[k - 2]:
+            ratio = (value - parameter_values[k - 1]) / (parameter_values[k - 1] - parameter_values[k - 2])
+            guess = {specie: max(solutions[-1][specie] + ratio * (solutions[-1][specie] - solutions[-2][specie]), 0)
+                     for specie in all_species}
+        elif k == 1:
+            guess = solutions[-1]
+        solution, info = solve_steady_state(all_species, parameters, reactions, fixed_species=fixed_species,
+                                            guess=guess, **kwargs)
+        if verbose:
+            print(f"{parameter} = {value}: {solution} ({info['method']}, {info['iterations']} iterations)")
+        solutions.append(solution)
+    values = {specie: np.array([solution[specie] for solution in solutions]) for specie in all_species}
+    return np.array(parameter_values), values
+
+
+def _pivot_laws(laws, concentrations):
+    """
+    Transforms the basis of conservation laws (columns of laws) so that each law has its own pivot species with
+    coefficient 1, not present in the other laws. The pivot is the most abundant species of the law, so that its
+    right-hand side equation (replaced by the conservation law in the Newton method) mixes concentrations of
+    different magnitudes as little as possible. Returns tuple (transformed laws, pivot indices).
+    """
+    laws = laws.copy()
+    pivots = []
+    for k in range(laws.shape[1]):
+        candidates = np.abs(laws[:, k]) * np.maximum(np.abs(concentrations), 1)
+        candidates[pivots] = 0
+        pivot = int(np.argmax(candidates))
+        laws[:, k] /= laws[pivot, k]
+        for other in range(laws.shape[1]):
+            if other != k:
+                laws[:, other] -= laws[pivot, other] * laws[:, k]
+        pivots.append(pivot)
+    return laws, pivots
+
+
+def _newton(c, rhs, jacobian, laws, pivots, totals, converged, max_iter, verbose):
+    """
+    Newton iteration for rhs(c) = 0 with the equations of the pivot species replaced by the conservation laws
+    laws.T @ c = totals. The steps are damped so that the positive concentrations stay non-negative and the
+    concentrations already at zero are clamped at zero.
+    Returns (solution or None if it did not converge, number of iterations).
+    """
+    for iteration in range(1, max_iter + 1):
+        residual = rhs(c)
+        residual[pivots] = laws.T @ c - totals
+        matrix = jacobian(c)
+        matrix[pivots] = laws.T
+        try:
+            step = np.linalg.solve(matrix, -residual)
+        except np.linalg.LinAlgError:  # e.g., at the trivial state without electrons, use the minimal-norm step
+            step = np.linalg.lstsq(matrix, -residual, rcond=None)[0]
+        c = np.maximum(c + _positive_damping(c, step) * step, 0)
+        if verbose:
+            print(f"newton iteration {iteration}: residual {np.abs(residual).max()}")
+        if converged(step, c):
+            return c, iteration
+    return None, max_iter
+
+
+def _pseudo_transient(c, rhs, jacobian, converged, max_steps, atol, verbose):
+    """
+    Pseudo-transient continuation: implicit Euler steps (I / dt - J) step = rhs(c). The step dt doubles after each
+    step changing no concentration by more than a half and it is reduced (and the step rejected) otherwise, so the
+    iteration follows the dynamics of the system towards a stable steady state and becomes the Newton method once
+    dt is large. The steps stay in the range of the stoichiometry matrix, so the conservation laws are preserved.
+    """
+    rate_scale = max(np.abs(np.diag(jacobian(c))).max(), 1e-300)
+    dt = 1 / rate_scale
+    f = rhs(c)
+    for step_number in range(max_steps):
+        step = np.linalg.solve(np.eye(len(c)) / dt - jacobian(c), f)
+        if not np.all(np.isfinite(step)):
+            break
+        if np.max(np.abs(step) / (np.abs(c) + atol)) > 0.5 or np.any(c + step < 0):
+            dt /= 4  # too large change, reject the step
+            continue
+        c = c + step
+        f = rhs(c)
+        if verbose and step_number % 100 == 0:
+            print(f"pseudo-transient step {step_number}: dt {dt}, residual {np.abs(f).max()}")
+        if converged(step, c) and dt * rate_scale > 1e6:
+            return c
+        dt = min(2 * dt, 1e12 / rate_scale)
+    raise SteadyStateError("The pseudo-transient continuation did not converge.")
+
+
+def _positive_damping(c, step):
+    """
+    Largest damping factor (at most 1) keeping the positive concentrations non-negative after the step
+    (the concentrations at zero would stop the iteration completely, they are clamped by the caller).
+    """
+    decreasing = (step < 0) & (c > 0)
+    if not decreasing.any():
+        return 1.0
+    return min(1.0, 0.9 * np.min(c[decreasing] / -step[decreasing]))